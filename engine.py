@@ -0,0 +1,1200 @@
+"""Simulation engine and batch tools (no Streamlit): run, validate, compare, export and sweep scenarios."""
+import ast
+import contextlib
+import hashlib
+import inspect
+import io
+import json
+import math
+import operator
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet
+
+# --- 0. LOGGING FUNCTION ---
+DEBUG_LOGGING = True # Switched off by muted_logging() (e.g. during sweeps)
+
+def log_debug(message):
+    """Prints a log to the terminal running Streamlit."""
+    if DEBUG_LOGGING:
+        print(f"DEBUG: {message}", file=sys.stderr)
+
+@contextlib.contextmanager
+def muted_logging():
+    """Silences log_debug() for the duration of the block (per-year logs cost about a third of batch throughput)."""
+    global DEBUG_LOGGING
+    previous, DEBUG_LOGGING = DEBUG_LOGGING, False
+    try:
+        yield
+    finally:
+        DEBUG_LOGGING = previous
+
+# --- 1. SIMULATION CONSTANTS (based on documents) ---
+MATERIAL_COST_PER_UNIT = 18.0
+LABOR_COST_PER_WORKER = 18000.0
+UNITS_PER_WORKER = 2000.0
+LABOR_COST_PER_UNIT = LABOR_COST_PER_WORKER / UNITS_PER_WORKER # 9.0
+UNIT_COST_FOR_COGS = MATERIAL_COST_PER_UNIT # 18.0
+UNIT_COST_FOR_INVENTORY = MATERIAL_COST_PER_UNIT + LABOR_COST_PER_UNIT # 27.0
+UNITS_PER_LINE = 10000.0
+COST_PER_NEW_LINE = 50000.0
+DEPRECIATION_PER_LINE = 10000.0
+BASE_ADMIN_SALARIES = 300000.0
+RENT_FACTORY_X7 = 300000.0 # Original rent
+RENT_FACTORY_X8_PLUS = 600000.0 # New rent from X8 onwards
+PROPERTY_TAX = 40000.0
+# AUDITING_FEES = 0.0 # Removed, now dynamic
+EXISTING_DEBT = 200000.0
+INTEREST_RATE_DEBT = 0.08 # Default initial rate
+INTEREST_RATE_OVERDRAFT = 0.10
+DEBT_REPAYMENT_YEAR = 2 # Year X8
+TAX_RATE = 0.40
+CASH_PAYMENT_RATE_SALES_X7 = 0.85 # Original payment rate
+CASH_PAYMENT_RATE_SALES_X8_PLUS = 0.80 # New payment rate from X8
+CASH_PAYMENT_RATE_PURCHASES = 0.90
+
+# --- 2. INITIAL STATE (END OF YEAR X6) ---
+INITIAL_BALANCE_SHEET = {
+    'year': 'X6',
+    'cash': 70000.0,
+    'accounts_receivable': 350000.0,
+    'inventory_finished_units': 5000.0,
+    'inventory_finished_value': 135000.0,
+    'inventory_materials_units': 10000.0,
+    'inventory_materials_value': 180000.0,
+    'gross_fixed_assets': 450000.0,
+    'accumulated_depreciation': 240000.0,
+    'accounts_payable': 235000.0,
+    'income_tax_payable': 60000.0,
+    'bank_overdraft': 0.0,
+    'long_term_debt': 200000.0,
+    'capital_stock': 250000.0,
+    'retained_earnings': 110000.0,
+    'net_income_previous_year': 90000.0,
+    'interest_rate': INTEREST_RATE_DEBT, # NEW v28: Track interest rate
+}
+# Auditor-Confirmed Correct Initial Ages
+INITIAL_LINE_AGES = {
+    'age_0': 0, # New
+    'age_1': 1, # Operated 1 year
+    'age_2': 3, # Operated 2 years
+    'age_3': 3, # Operated 3 years
+    'age_4': 2, # Operated 4 years (These 2 will be scrapped at end of X7)
+}
+INITIAL_WORKERS = 50
+
+# Production line types. A line is scrapped at the end of the year it reaches age useful_life - 1.
+LINE_TYPES = {
+    'standard': {
+        'capacity': UNITS_PER_LINE,
+        'cost': COST_PER_NEW_LINE,
+        'depreciation': DEPRECIATION_PER_LINE, # Straight-line: cost / useful_life
+        'useful_life': 5, # Ages 0-4
+    },
+}
+DEFAULT_LINE_TYPE = 'standard'
+
+# --- 2b. LINE FLEET (RING BUFFER PER LINE TYPE) ---
+
+class LineFleet:
+    """
+    Machine park as one ring buffer of line counts per line type.
+    The count of lines at age k sits at slot (head - k) % useful_life, so aging a year only
+    moves the head.
+    """
+
+    def __init__(self, line_types=LINE_TYPES):
+        self.line_types = line_types
+        self.slots = {t: [0] * spec['useful_life'] for t, spec in line_types.items()}
+        self.heads = {t: 0 for t in line_types}
+        self.counts = {t: 0 for t in line_types} # Running totals, kept in step with the slots
+
+    @classmethod
+    def from_age_counts(cls, age_counts, line_type=DEFAULT_LINE_TYPE, line_types=LINE_TYPES):
+        """Builds a fleet from an {'age_k': count} dict. Lines past their useful life land in the oldest slot."""
+        fleet = cls(line_types)
+        oldest = line_types[line_type]['useful_life'] - 1
+        for key, count in age_counts.items():
+            fleet.add(line_type, min(int(key.split('_')[1]), oldest), count)
+        return fleet
+
+    def copy(self):
+        fleet = LineFleet.__new__(LineFleet)
+        fleet.line_types = self.line_types
+        fleet.slots = {t: list(slots) for t, slots in self.slots.items()}
+        fleet.heads = dict(self.heads)
+        fleet.counts = dict(self.counts)
+        return fleet
+
+    def add(self, line_type, age, count):
+        slots = self.slots[line_type]
+        idx = (self.heads[line_type] - age) % len(slots)
+        slots[idx] = slots[idx] + count
+        self.counts[line_type] = self.counts[line_type] + count
+
+    def count_at_age(self, age, line_type=None):
+        types = [line_type] if line_type is not None else self.slots
+        total = 0
+        for t in types:
+            slots = self.slots[t]
+            if age < len(slots):
+                total = total + slots[(self.heads[t] - age) % len(slots)]
+        return total
+
+    def total_lines(self):
+        return sum(self.counts.values())
+
+    def capacity(self):
+        return sum(self.counts[t] * spec['capacity'] for t, spec in self.line_types.items())
+
+    def depreciation(self):
+        return sum(self.counts[t] * spec['depreciation'] for t, spec in self.line_types.items())
+
+    def advance_year(self, purchases):
+        """
+        Ages the park by one year in place: lines at the end of their useful life are scrapped
+        and `purchases` ({line_type: count}) enter as age-0 lines. Returns the number of lines scrapped.
+        """
+        scrapped = 0
+        for t, slots in self.slots.items():
+            head = (self.heads[t] + 1) % len(slots) # The oldest slot becomes the new age-0 slot
+            lines_out = slots[head]
+            lines_in = purchases.get(t, 0)
+            slots[head] = lines_in
+            self.heads[t] = head
+            self.counts[t] = self.counts[t] - lines_out + lines_in
+            scrapped = scrapped + lines_out
+        return scrapped
+
+    def as_age_dict_by_type(self):
+        """{line_type: {'age_k': count}}, each type over its own useful life."""
+        return {t: {f'age_{k}': self.count_at_age(k, t) for k in range(len(slots))} for t, slots in self.slots.items()}
+
+# --- 3. SIMULATION ENGINE (RUNS ONE YEAR AT A TIME) ---
+
+def run_one_year(year_label, year_index, prev_bs, prev_lines, prev_workers, decisions, trace=None, park_snapshots=True):
+    """
+    Simulates a single year and returns all calculated data and the new "previous state".
+    `prev_lines` is aged in place and returned as the new park; pass a copy to keep the start-of-year park.
+    With `park_snapshots`, the start and end park compositions are added to the line flow data for display.
+    If `trace` is a dict, it is filled with the value of every LINEAGE_GRAPH node (see record_lineage).
+    """
+    log_debug(f"--- Calculating Year {year_label} (Index {year_index}) ---")
+    
+    cf_data, is_data, bs_data, bs_internal, inventory_flow_data, lines_flow_data = {}, {}, {}, {}, {}, {}
+    
+    # --- A. STRATEGIC DECISIONS ---
+    target_production_volume = decisions['prod_volume']
+    
+    line_type = decisions.get('line_type', DEFAULT_LINE_TYPE)
+    line_spec = LINE_TYPES[line_type]
+
+    # --- B. PRODUCTION PLANNING (CAPACITY) ---
+    total_existing_lines = prev_lines.total_lines()
+    existing_line_capacity = prev_lines.capacity()
+    log_debug(f"[{year_label}] Lines (start): {total_existing_lines} - Capacity: {existing_line_capacity}")
+
+    new_lines_needed = 0
+    if target_production_volume > existing_line_capacity:
+        new_lines_needed = math.ceil((target_production_volume - existing_line_capacity) / line_spec['capacity'])
+        log_debug(f"[{year_label}] NEW LINES PURCHASED ({line_type}): {new_lines_needed}")
+
+    investment_cash_out = new_lines_needed * line_spec['cost']
+    total_line_capacity = existing_line_capacity + new_lines_needed * line_spec['capacity']
+    
+    current_workers = prev_workers
+    existing_worker_capacity = current_workers * UNITS_PER_WORKER
+    new_workers_needed = 0
+    if target_production_volume > existing_worker_capacity:
+        new_workers_needed = math.ceil((target_production_volume - existing_worker_capacity) / UNITS_PER_WORKER)
+        log_debug(f"[{year_label}] NEW EMPLOYEES HIRED: {new_workers_needed}")
+        current_workers += new_workers_needed
+    
+    total_worker_capacity = current_workers * UNITS_PER_WORKER
+    
+    production_capacity = min(total_line_capacity, total_worker_capacity)
+    production_volume = min(target_production_volume, production_capacity)
+    log_debug(f"[{year_label}] Production: Target={target_production_volume}, Capacity={production_capacity}, Actual Production={production_volume}")
+    
+    # --- C. INCOME STATEMENT (AUDIT FIX E1) ---
+    
+    # C1. Sales & Revenue
+    opening_inv_units = prev_bs['inventory_finished_units']
+    total_available_for_sale = opening_inv_units + production_volume
+    
+    target_sales_units = decisions['target_sales_units']
+    actual_sales_volume = min(target_sales_units, total_available_for_sale)
+    
+    percent_sold_of_available = (actual_sales_volume / total_available_for_sale) if total_available_for_sale > 0 else 0
+    log_debug(f"[{year_label}] Sales: Available={total_available_for_sale}, Target={target_sales_units}, Actual Sold={actual_sales_volume} ({percent_sold_of_available*100:.1f}%)")
+    
+    revenue = actual_sales_volume * decisions['price']
+    
+    # C2. Finished Inventory Change (E-B)
+    opening_inv_fin_val = prev_bs['inventory_finished_value']
+    ending_inv_units = opening_inv_units + production_volume - actual_sales_volume
+    ending_inv_fin_val = ending_inv_units * UNIT_COST_FOR_INVENTORY # Valued at 27 CU
+    change_in_finished_inv = ending_inv_fin_val - opening_inv_fin_val # (E-B)
+    
+    # C3. Operating Revenue (Per Template)
+    operating_revenue = revenue + change_in_finished_inv
+    
+    # C4. Material Expense (Per Template)
+    materials_needed = production_volume
+    materials_from_stock = prev_bs['inventory_materials_units']
+    materials_to_purchase = max(0, materials_needed - materials_from_stock)
+    cost_materials_to_purchase = materials_to_purchase * MATERIAL_COST_PER_UNIT
+    
+    opening_inv_mat_val = prev_bs['inventory_materials_value']
+    ending_mat_units = materials_from_stock - materials_needed + materials_to_purchase
+    ending_inv_mat_val = ending_mat_units * MATERIAL_COST_PER_UNIT
+    change_in_raw_inv = opening_inv_mat_val - ending_inv_mat_val # (B-E)
+    
+    material_expense = cost_materials_to_purchase + change_in_raw_inv
+    
+    # C5. Other Operating Expenses (NEW LOGIC v28)
+    rent_for_year = RENT_FACTORY_X8_PLUS if year_index >= 2 else RENT_FACTORY_X7 # year_index 1 is X7, 2 is X8
+    
+    # NEW v28: Exceptional Audit Fee in X8
+    current_audit_fees = 0.0
+    if year_index == 2: # Year X8
+        current_audit_fees = 10000.0
+        log_debug(f"[{year_label}] Applying 10k exceptional audit fee.")
+    
+    personnel_expenses = current_workers * LABOR_COST_PER_WORKER + BASE_ADMIN_SALARIES
+    external_expenses_base = rent_for_year + PROPERTY_TAX + current_audit_fees
+    existing_line_depreciation = prev_lines.depreciation()
+    depreciation_expense = existing_line_depreciation + new_lines_needed * line_spec['depreciation']
+    
+    # C6. Marketing Expense (NEW LOGIC v28: Direct amount)
+    marketing_expense = decisions['marketing_amount']
+    
+    # C7. Total Operating Expense & EBIT
+    operating_expense = material_expense + personnel_expenses + external_expenses_base + marketing_expense + depreciation_expense
+    ebit = operating_revenue - operating_expense
+    
+    # C8. Financial Charges (NEW LOGIC v28: Dynamic rate)
+    current_interest_rate = prev_bs.get('interest_rate', INTEREST_RATE_DEBT)
+    interest_fixed_debt = prev_bs['long_term_debt'] * current_interest_rate
+    interest_overdraft = 0.0
+    
+    # --- D. CASH FLOW STATEMENT (CF) ---
+    
+    current_cash_payment_rate_sales = CASH_PAYMENT_RATE_SALES_X8_PLUS if year_index >= 2 else CASH_PAYMENT_RATE_SALES_X7
+    log_debug(f"[{year_label}] Sales cash payment rate: {current_cash_payment_rate_sales}")
+
+    # D1. Tentative Cash Flow (to find Overdraft)
+    cash_from_sales_AR = prev_bs['accounts_receivable']
+    cash_from_sales_current = revenue * current_cash_payment_rate_sales
+    
+    cash_out_purchases_AP = prev_bs['accounts_payable']
+    cash_out_purchases_current = cost_materials_to_purchase * CASH_PAYMENT_RATE_PURCHASES
+    
+    cash_out_personnel = personnel_expenses
+    cash_out_external = external_expenses_base + marketing_expense # Full cash out
+    cash_out_interest_fixed = interest_fixed_debt # Pay fixed interest
+    cash_out_income_tax = prev_bs['income_tax_payable']
+    
+    tentative_total_cash_out = (cash_out_purchases_AP + cash_out_purchases_current + 
+                                cash_out_personnel + cash_out_external + 
+                                cash_out_interest_fixed + cash_out_income_tax)
+    
+    tentative_cfo = (cash_from_sales_AR + cash_from_sales_current) - tentative_total_cash_out
+    
+    cfi = -investment_cash_out
+    
+    # D2. Dividends & Financing (NEW LOGIC v28: Refinancing)
+    dividends_paid = min(decisions['dividends_amount'], prev_bs['net_income_previous_year'])
+    
+    debt_repayment = 0
+    new_loan_cash_in = 0
+    
+    if year_index == DEBT_REPAYMENT_YEAR: # DEBT_REPAYMENT_YEAR = 2 (X8)
+        if decisions.get('refinance_loan', False):
+            # 1. Repay the old 200k loan
+            debt_repayment = min(prev_bs['long_term_debt'], EXISTING_DEBT)
+            # 2. Take out the new loan
+            new_loan_cash_in = decisions['new_loan_amount']
+            log_debug(f"[{year_label}] Refinancing: Repaying {debt_repayment}, taking new loan {new_loan_cash_in}")
+        else:
+            # Original logic: just repay
+            debt_repayment = min(prev_bs['long_term_debt'], EXISTING_DEBT)
+            log_debug(f"[{year_label}] DEBT REPAYMENT (no refinance): {debt_repayment}")
+            
+    cff = -dividends_paid - debt_repayment + new_loan_cash_in
+    
+    # D3. Overdraft Interest Calculation (AUDIT FIX E2)
+    opening_net_cash = prev_bs['cash'] - prev_bs['bank_overdraft']
+    tentative_cash_flow = tentative_cfo + cfi + cff
+    tentative_ending_net_cash = opening_net_cash + tentative_cash_flow
+    
+    if tentative_ending_net_cash < 0:
+        tentative_overdraft = -tentative_ending_net_cash
+        interest_overdraft = (tentative_overdraft * INTEREST_RATE_OVERDRAFT) / (1.0 - INTEREST_RATE_OVERDRAFT)
+        log_debug(f"[{year_label}] Overdraft interest loop: {interest_overdraft}")
+    
+    # --- E. FINAL IS, CF, and BS ---
+    
+    # E1. Final Income Statement
+    financial_charges = interest_fixed_debt + interest_overdraft
+    ebt = ebit - financial_charges # ebit was calculated before any interest
+    
+    # E2. Income Tax (AUDIT FIX E3)
+    income_tax = max(0, math.floor(ebt * TAX_RATE / 1000) * 1000)
+    net_income = ebt - income_tax
+    
+    # E3. Final Cash Flow
+    cash_out_interest = financial_charges # This is the full cash out for interest
+    total_cash_out_operating = (cash_out_purchases_AP + cash_out_purchases_current + 
+                                cash_out_personnel + cash_out_external + 
+                                cash_out_interest + cash_out_income_tax)
+    
+    cfo = (cash_from_sales_AR + cash_from_sales_current) - total_cash_out_operating
+    net_cash_flow = cfo + cfi + cff
+    ending_net_cash = opening_net_cash + net_cash_flow
+    
+    # Populate IS_DATA (for display)
+    is_data['Revenue - Sales'] = revenue
+    is_data['Revenue - Inventory Change (E-B)'] = change_in_finished_inv
+    is_data['Operating Revenue'] = operating_revenue
+    is_data['Expenses - Material Expense'] = material_expense
+    is_data['Expenses - External (Rent, Tax...)'] = external_expenses_base
+    is_data['Expenses - Marketing'] = marketing_expense
+    is_data['Expenses - Personnel'] = personnel_expenses
+    is_data['Expenses - Depreciation'] = depreciation_expense
+    is_data['Operating Expense'] = operating_expense
+    is_data['EBIT'] = ebit
+    is_data['Expenses - Financial Charges'] = financial_charges
+    is_data['Earnings Before Tax (EBT)'] = ebt
+    is_data['Taxes'] = income_tax
+    is_data['Net Income'] = net_income
+    # NEW v28: Metric for Mktg %
+    is_data['METRIC_mktg_pct_of_opex'] = (marketing_expense / operating_expense) if operating_expense > 0 else 0
+    
+    # Populate CF_DATA (for display)
+    cf_data['Opening Balance (net)'] = opening_net_cash
+    cf_data['Operating Cash Flow (CFO)'] = cfo
+    cf_data['... Cash In (Y-1)'] = cash_from_sales_AR
+    cf_data['... Cash In (Y)'] = cash_from_sales_current
+    cf_data['... Cash Out (Operating)'] = -total_cash_out_operating 
+    cf_data['Cash Out - Personnel'] = -cash_out_personnel
+    cf_data['Cash Out - External & Mktg'] = -(external_expenses_base + marketing_expense)
+    cf_data['Cash Out - Interest'] = -cash_out_interest
+    cf_data['Cash Out - Taxes (from Y-1)'] = -cash_out_income_tax
+    cf_data['Cash Out - Purchases (Current 90%)'] = -cash_out_purchases_current
+    cf_data['Cash Out - Payables (from Y-1)'] = -cash_out_purchases_AP
+    cf_data['Investing Cash Flow (CFI)'] = cfi
+    cf_data['Financing Cash Flow (CFF)'] = cff
+    cf_data['Net Change in Cash'] = net_cash_flow
+    cf_data['Ending Balance (net)'] = ending_net_cash
+    
+    # E4. Final Balance Sheet
+    if ending_net_cash >= 0:
+        bs_internal['cash'] = ending_net_cash
+        bs_internal['bank_overdraft'] = 0.0
+    else:
+        bs_internal['cash'] = 0.0
+        bs_internal['bank_overdraft'] = -ending_net_cash
+        
+    bs_internal['accounts_receivable'] = revenue * (1.0 - current_cash_payment_rate_sales)
+    bs_internal['inventory_materials_units'] = ending_mat_units
+    bs_internal['inventory_materials_value'] = ending_inv_mat_val
+    bs_internal['inventory_finished_units'] = ending_inv_units
+    bs_internal['inventory_finished_value'] = ending_inv_fin_val
+    
+    bs_internal['gross_fixed_assets'] = prev_bs['gross_fixed_assets'] + investment_cash_out
+    bs_internal['accumulated_depreciation'] = prev_bs['accumulated_depreciation'] + depreciation_expense
+    net_fixed_assets = bs_internal['gross_fixed_assets'] - bs_internal['accumulated_depreciation']
+    
+    bs_internal['accounts_payable'] = cost_materials_to_purchase * (1.0 - CASH_PAYMENT_RATE_PURCHASES)
+    bs_internal['income_tax_payable'] = income_tax
+    
+    # NEW v28: Update Debt and Interest Rate
+    bs_internal['long_term_debt'] = prev_bs['long_term_debt'] - debt_repayment + new_loan_cash_in
+    bs_internal['interest_rate'] = prev_bs.get('interest_rate', INTEREST_RATE_DEBT) # Default carry-over
+    if year_index == DEBT_REPAYMENT_YEAR and decisions.get('refinance_loan', False):
+        bs_internal['interest_rate'] = decisions['new_loan_rate'] / 100.0
+        log_debug(f"[{year_label}] New interest rate set for next year: {bs_internal['interest_rate']*100}%")
+    
+    bs_internal['capital_stock'] = prev_bs['capital_stock']
+    retained_from_previous = prev_bs['net_income_previous_year'] - dividends_paid
+    bs_internal['retained_earnings'] = prev_bs['retained_earnings'] + retained_from_previous
+    bs_internal['net_income_previous_year'] = net_income
+    
+    # Populate BS_DATA (for display)
+    bs_data['Fixed Assets - Equipment (Net)'] = net_fixed_assets
+    bs_data['Current Assets - Material Inv.'] = bs_internal['inventory_materials_value']
+    bs_data['Current Assets - Finished Inv.'] = bs_internal['inventory_finished_value']
+    bs_data['Current Assets - Receivables (AR)'] = bs_internal['accounts_receivable']
+    bs_data['Current Assets - Cash'] = bs_internal['cash']
+    total_current_assets = bs_internal['inventory_materials_value'] + bs_internal['inventory_finished_value'] + bs_internal['accounts_receivable'] + bs_internal['cash']
+    total_assets = net_fixed_assets + total_current_assets
+    bs_data['TOTAL ASSETS'] = total_assets
+    
+    bs_data['Equity - Capital Stock'] = bs_internal['capital_stock']
+    bs_data['Equity - Retained Earnings'] = bs_internal['retained_earnings']
+    bs_data['Equity - Net Income (Y)'] = bs_internal['net_income_previous_year']
+    total_equity = bs_internal['capital_stock'] + bs_internal['retained_earnings'] + bs_internal['net_income_previous_year']
+    bs_data['Total Equity'] = total_equity
+    
+    bs_data['Liabilities - Long-Term Debt'] = bs_internal['long_term_debt']
+    bs_data['Liabilities - Bank Overdraft (ST)'] = bs_internal['bank_overdraft']
+    bs_data['Liabilities - Payables (AP)'] = bs_internal['accounts_payable']
+    bs_data['Liabilities - Taxes Payable'] = bs_internal['income_tax_payable']
+    total_current_liabilities = bs_internal['bank_overdraft'] + bs_internal['accounts_payable'] + bs_internal['income_tax_payable']
+    total_liabilities = bs_internal['long_term_debt'] + total_current_liabilities
+    bs_data['Total Liabilities'] = total_liabilities
+    bs_data['TOTAL LIABILITIES + EQUITY'] = total_equity + total_liabilities
+    
+    # Metrics
+    bs_data['METRIC_ROE'] = net_income / total_equity if total_equity != 0 else 0
+    bs_data['METRIC_Current_Ratio'] = total_current_assets / total_current_liabilities if total_current_liabilities > 0 else 0
+
+    # --- F. AGING & ITERATION (AUDIT FIX E4) ---
+    if park_snapshots:
+        lines_flow_data['park_composition_start'] = prev_lines.as_age_dict_by_type() # Show state at start of year
+    next_lines = prev_lines # Aged in place (start-of-year figures were read above)
+    lines_scrapped = next_lines.advance_year({line_type: new_lines_needed}) # Lines at end of useful life
+
+    if lines_scrapped > 0:
+        log_debug(f"[{year_label}] {lines_scrapped} lines (end of useful life) were scrapped at END of year.")
+
+    # Data for this year's display
+    lines_flow_data['opening_lines'] = total_existing_lines
+    lines_flow_data['opening_capacity'] = existing_line_capacity
+    lines_flow_data['purchased_this_year'] = new_lines_needed
+    lines_flow_data['capacity_purchased'] = new_lines_needed * line_spec['capacity']
+    lines_flow_data['capacity_during_year'] = total_line_capacity
+    lines_flow_data['scrapped_this_year'] = lines_scrapped
+    lines_flow_data['capacity_scrapped'] = total_line_capacity - next_lines.capacity()
+    lines_flow_data['ending_lines'] = next_lines.total_lines()
+    lines_flow_data['capacity_next_year'] = next_lines.capacity()
+    if park_snapshots:
+        lines_flow_data['park_composition_end'] = next_lines.as_age_dict_by_type() # EOY state for expander
+    
+    # Inventory Flow Data
+    inventory_flow_data['fg_opening'] = opening_inv_units
+    inventory_flow_data['fg_produced'] = production_volume
+    inventory_flow_data['fg_sold'] = actual_sales_volume
+    inventory_flow_data['fg_ending'] = ending_inv_units
+    inventory_flow_data['fg_percent_sold_of_available'] = percent_sold_of_available
+    inventory_flow_data['mat_opening'] = materials_from_stock
+    inventory_flow_data['mat_purchased'] = materials_to_purchase
+    inventory_flow_data['mat_used'] = materials_needed
+    inventory_flow_data['mat_ending'] = ending_mat_units
+    
+    next_workers = current_workers
+
+    if trace is not None: # Opt-in: nothing is recorded or allocated when tracing is off
+        record_lineage(trace, locals())
+    
+    log_debug(f"[{year_label}] END Year Loop.")
+    
+    return cf_data, is_data, bs_data, bs_internal, lines_flow_data, inventory_flow_data, next_lines, next_workers
+
+
+YEAR_LABELS = ['X7', 'X8', 'X9', 'X10', 'X11']
+
+RESULT_SECTIONS = ['cf', 'is', 'bs', 'lines', 'inventory']
+
+def run_horizon(all_decisions, baseline=None, trace=False, snapshots=True):
+    """
+    Runs X7 to X11 from the X6 initial state.
+    Returns {'cf', 'is', 'bs', 'lines', 'inventory'} dicts keyed by year label, plus the decisions,
+    the end-of-year state of each year and the number of years reused from `baseline`.
+    If `baseline` (an earlier run_horizon result) has identical decisions for X7..Xk, those years
+    are reused as-is and the run restarts from the baseline's end-of-Xk state.
+    With `trace`, results['lineage'] holds the LINEAGE_GRAPH node values of each year.
+    Without `snapshots` (batch runs), end-of-year states and park compositions are not kept,
+    so the result cannot serve as a baseline and has no park display data.
+    """
+    results = {section: {} for section in RESULT_SECTIONS}
+    results['decisions'] = {year_label: dict(all_decisions[year_label]) for year_label in YEAR_LABELS}
+    results['states'] = {} # End-of-year (bs_internal, lines, workers), only with `snapshots`
+    if trace:
+        results['lineage'] = {}
+
+    shared_years = 0
+    if baseline is not None and baseline['states'] and (not trace or 'lineage' in baseline): # A traced run only reuses traced years
+        while (shared_years < len(YEAR_LABELS) and
+               all_decisions[YEAR_LABELS[shared_years]] == baseline['decisions'][YEAR_LABELS[shared_years]]):
+            shared_years += 1
+    results['reused_years'] = shared_years
+
+    prev_bs = INITIAL_BALANCE_SHEET.copy()
+    prev_lines = LineFleet.from_age_counts(INITIAL_LINE_AGES)
+    prev_workers = INITIAL_WORKERS
+
+    for year_label in YEAR_LABELS[:shared_years]: # Shared prefix: results are read-only, no copy needed
+        for section in RESULT_SECTIONS:
+            results[section][year_label] = baseline[section][year_label]
+        results['states'][year_label] = baseline['states'][year_label]
+        if trace:
+            results['lineage'][year_label] = baseline['lineage'][year_label]
+    if shared_years > 0:
+        prev_bs, prev_lines, prev_workers = baseline['states'][YEAR_LABELS[shared_years - 1]]
+        prev_lines = prev_lines.copy() # The park is aged in place; the baseline's state stays untouched
+        log_debug(f"Reusing {shared_years} year(s) from baseline.")
+
+    for year_index, year_label in enumerate(YEAR_LABELS, start=1):
+        if year_index <= shared_years:
+            continue
+        year_trace = {} if trace else None
+        cf_data, is_data, bs_data, bs_internal, lines_data, inv_data, \
+        next_lines, next_workers = run_one_year(
+            year_label, year_index, prev_bs, prev_lines, prev_workers, all_decisions[year_label], trace=year_trace,
+            park_snapshots=snapshots
+        )
+        if trace:
+            results['lineage'][year_label] = year_trace
+
+        results['cf'][year_label] = cf_data
+        results['is'][year_label] = is_data
+        results['bs'][year_label] = bs_data
+        results['lines'][year_label] = lines_data
+        results['inventory'][year_label] = inv_data
+        if snapshots:
+            results['states'][year_label] = (bs_internal, next_lines.copy(), next_workers)
+
+        prev_bs = bs_internal.copy()
+        prev_lines = next_lines
+        prev_workers = next_workers
+
+    return results
+
+
+# --- 3b. BATCH VALIDATION (ACCOUNTING INVARIANTS) ---
+VALIDATION_RTOL = 1e-6
+VALIDATION_ATOL = 0.01 # CU
+
+# Result lines checked by validate_result_arrays, per result section
+VALIDATED_LINES = {
+    'cf': ['Opening Balance (net)', 'Net Change in Cash', 'Ending Balance (net)'],
+    'bs': ['TOTAL ASSETS', 'TOTAL LIABILITIES + EQUITY', 'Current Assets - Cash', 'Liabilities - Bank Overdraft (ST)'],
+    'inventory': ['fg_opening', 'fg_produced', 'fg_sold', 'fg_ending', 'mat_opening', 'mat_purchased', 'mat_used', 'mat_ending'],
+}
+
+def results_to_arrays(batch_results, lines=VALIDATED_LINES):
+    """Stacks a list of run_horizon() results into {section: {line: array (n_scenarios, n_years)}}."""
+    arrays = {}
+    for section, keys in lines.items():
+        keys = list(keys)
+        # One pass over each result/year dict: all lines of the year are read in C by itemgetter
+        getter = operator.itemgetter(*keys) if len(keys) > 1 else (lambda year_data: tuple(year_data[key] for key in keys))
+        block = np.empty((len(batch_results), len(YEAR_LABELS), len(keys)))
+        for row, res in enumerate(batch_results):
+            section_data = res[section]
+            block[row] = [getter(section_data[y]) for y in YEAR_LABELS]
+        block = np.ascontiguousarray(block.transpose(2, 0, 1)) # (n_lines, n_scenarios, n_years)
+        arrays[section] = {key: block[k] for k, key in enumerate(keys)}
+    return arrays
+
+def validate_result_arrays(arrays, scenario_ids=None):
+    """
+    Checks the accounting invariants over whole (n_scenarios, n_years) result arrays.
+    Returns {invariant: [offending scenario IDs]}; an empty dict means every scenario passed.
+    """
+    cf, bs, inv = arrays['cf'], arrays['bs'], arrays['inventory']
+    n_scenarios = cf['Ending Balance (net)'].shape[0]
+    scenario_ids = np.arange(n_scenarios) if scenario_ids is None else np.asarray(scenario_ids)
+
+    def differs(a, b):
+        return ~np.isclose(a, b, rtol=VALIDATION_RTOL, atol=VALIDATION_ATOL)
+
+    def any_year(*bad_cells):
+        """Reduces (n_scenarios, n_years) failure masks to one flag per scenario."""
+        flags = np.zeros(n_scenarios, dtype=bool)
+        for bad in bad_cells:
+            flags |= bad.any(axis=1)
+        return flags
+
+    opening_cash, closing_cash = cf['Opening Balance (net)'], cf['Ending Balance (net)']
+    initial_net_cash = INITIAL_BALANCE_SHEET['cash'] - INITIAL_BALANCE_SHEET['bank_overdraft']
+    failures = {
+        'balance_sheet_identity': any_year(differs(bs['TOTAL ASSETS'], bs['TOTAL LIABILITIES + EQUITY'])),
+        'cash_flow_closing': any_year(differs(closing_cash, opening_cash + cf['Net Change in Cash'])),
+        'cash_flow_continuity': any_year(
+            differs(opening_cash[:, :1], initial_net_cash),
+            differs(opening_cash[:, 1:], closing_cash[:, :-1]),
+        ),
+        'cash_matches_balance_sheet': any_year(
+            differs(closing_cash, bs['Current Assets - Cash'] - bs['Liabilities - Bank Overdraft (ST)'])),
+        'finished_goods_conservation': any_year(
+            differs(inv['fg_ending'], inv['fg_opening'] + inv['fg_produced'] - inv['fg_sold']),
+            differs(inv['fg_opening'][:, 1:], inv['fg_ending'][:, :-1]),
+        ),
+        'materials_conservation': any_year(
+            differs(inv['mat_ending'], inv['mat_opening'] + inv['mat_purchased'] - inv['mat_used']),
+            differs(inv['mat_opening'][:, 1:], inv['mat_ending'][:, :-1]),
+        ),
+        'non_negative_stocks': any_year(
+            inv['fg_ending'] < -VALIDATION_ATOL,
+            inv['mat_ending'] < -VALIDATION_ATOL,
+            bs['Current Assets - Cash'] < -VALIDATION_ATOL,
+            bs['Liabilities - Bank Overdraft (ST)'] < -VALIDATION_ATOL,
+        ),
+    }
+    return {name: scenario_ids[flags].tolist() for name, flags in failures.items() if flags.any()}
+
+
+# --- 3c. SCENARIO COMPARISON ---
+MAX_COMPARE_VARIANTS = 4
+COMPARED_SECTIONS = ['cf', 'is', 'bs', 'inventory']
+
+def compare_results(baseline, variant):
+    """
+    Per-line deltas (variant - baseline) for every year.
+    Returns {section: {line: [delta for each of YEAR_LABELS]}}; non-numeric lines are skipped.
+    """
+    deltas = {}
+    for section in COMPARED_SECTIONS:
+        deltas[section] = {}
+        for line, value in baseline[section][YEAR_LABELS[0]].items():
+            if isinstance(value, (int, float)):
+                deltas[section][line] = [variant[section][y][line] - baseline[section][y][line] for y in YEAR_LABELS]
+    return deltas
+
+
+# --- 3d. EXPORT (WORKBOOK & COLUMNAR) ---
+EXPORT_SHEETS = {
+    'cf': 'Cash Flow',
+    'is': 'Income Statement',
+    'bs': 'Balance Sheet',
+    'lines': 'Line Flow',
+    'inventory': 'Inventory Flow',
+}
+# Lines shown in bold in the workbook (same as the totals in the app)
+EXPORT_TOTAL_LINES = {
+    'Operating Cash Flow (CFO)', 'Investing Cash Flow (CFI)', 'Financing Cash Flow (CFF)', 'Ending Balance (net)',
+    'Operating Revenue', 'Operating Expense', 'EBIT', 'Net Income',
+    'TOTAL ASSETS', 'Total Equity', 'Total Liabilities', 'TOTAL LIABILITIES + EQUITY',
+    'ending_lines', 'fg_ending', 'mat_ending',
+}
+# Lines formatted as percentages / as plain ratios in the workbook
+EXPORT_PERCENT_LINES = {'METRIC_ROE', 'METRIC_mktg_pct_of_opex', 'fg_percent_sold_of_available'}
+EXPORT_RATIO_LINES = {'METRIC_Current_Ratio'}
+
+def flatten_year_data(year_data):
+    """Flattens nested lines (e.g. park composition {line_type: {'age_k': count}}) into 'line - sub_line' entries."""
+    flat = {}
+    for line, value in year_data.items():
+        if isinstance(value, dict):
+            for sub_line, sub_value in flatten_year_data(value).items():
+                flat[f"{line} - {sub_line}"] = sub_value
+        else:
+            flat[line] = value
+    return flat
+
+def export_workbook(results):
+    """
+    Writes every year's cash flow, income statement, balance sheet, line flow and inventory flow of one run
+    to a formatted .xlsx workbook (one sheet per statement, one column per year, figures in CU).
+    Requires the optional xlsxwriter package. Returns the file content as bytes.
+    """
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        workbook = writer.book
+        amount_format = workbook.add_format({'num_format': '#,##0;(#,##0)'})
+        total_format = workbook.add_format({'num_format': '#,##0;(#,##0)', 'bold': True, 'top': 1})
+        percent_format = workbook.add_format({'num_format': '0.0%', 'italic': True})
+        ratio_format = workbook.add_format({'num_format': '0.00', 'italic': True})
+
+        for section, sheet_name in EXPORT_SHEETS.items():
+            table = {y: flatten_year_data(results[section][y]) for y in YEAR_LABELS}
+            frame = pd.DataFrame(table, columns=YEAR_LABELS)
+            frame.to_excel(writer, sheet_name=sheet_name, index_label=sheet_name)
+
+            worksheet = writer.sheets[sheet_name]
+            worksheet.set_column(0, 0, 42)
+            worksheet.set_column(1, len(YEAR_LABELS), 14)
+            worksheet.freeze_panes(1, 1)
+            for row, line in enumerate(frame.index, start=1):
+                if line in EXPORT_PERCENT_LINES:
+                    worksheet.set_row(row, None, percent_format)
+                elif line in EXPORT_RATIO_LINES:
+                    worksheet.set_row(row, None, ratio_format)
+                elif line in EXPORT_TOTAL_LINES:
+                    worksheet.set_row(row, None, total_format)
+                else:
+                    worksheet.set_row(row, None, amount_format)
+    return buffer.getvalue()
+
+def export_result_arrays(arrays, path, scenario_ids=None):
+    """
+    Writes {section: {line: array (n_scenarios, n_years)}} result arrays (see results_to_arrays) to a columnar file,
+    one row per scenario and one 'section|line|year' column per line and year.
+    The format follows the extension: .parquet or .csv, both written by pyarrow from whole columns (no per-cell Python work).
+    """
+    path = str(path)
+    if not path.endswith(('.parquet', '.csv')):
+        raise ValueError(f"Unsupported export format: {path} (use .parquet or .csv)")
+
+    n_scenarios = next(iter(next(iter(arrays.values())).values())).shape[0]
+    columns = {'scenario_id': pa.array(np.arange(n_scenarios) if scenario_ids is None else np.asarray(scenario_ids))}
+    for section, section_arrays in arrays.items():
+        for line, values in section_arrays.items():
+            by_year = np.ascontiguousarray(values.T) # One contiguous row per year -> zero-copy columns
+            for j, year_label in enumerate(YEAR_LABELS):
+                columns[f"{section}|{line}|{year_label}"] = pa.array(by_year[j])
+    table = pa.table(columns)
+
+    if path.endswith('.parquet'):
+        pyarrow.parquet.write_table(table, path)
+    else:
+        pyarrow.csv.write_csv(table, path)
+    log_debug(f"Exported {n_scenarios} scenarios x {len(columns) - 1} columns to {path}")
+
+
+# --- 3e. CHECKPOINTED SWEEPS ---
+SWEEP_CHECKPOINT_EVERY = 1000 # Scenarios per checkpoint (one chunk file each)
+SWEEP_STATS = ['sum', 'sum_sq', 'min', 'max']
+# Lines kept by run_sweep by default: every numeric cash flow, income statement, balance sheet and inventory line
+SWEEP_LINES = {
+    'cf': ['Opening Balance (net)', 'Operating Cash Flow (CFO)', '... Cash In (Y-1)', '... Cash In (Y)',
+        '... Cash Out (Operating)', 'Cash Out - Personnel', 'Cash Out - External & Mktg', 'Cash Out - Interest',
+        'Cash Out - Taxes (from Y-1)', 'Cash Out - Purchases (Current 90%)', 'Cash Out - Payables (from Y-1)',
+        'Investing Cash Flow (CFI)', 'Financing Cash Flow (CFF)', 'Net Change in Cash', 'Ending Balance (net)'],
+    'is': ['Revenue - Sales', 'Revenue - Inventory Change (E-B)', 'Operating Revenue', 'Expenses - Material Expense',
+        'Expenses - External (Rent, Tax...)', 'Expenses - Marketing', 'Expenses - Personnel',
+        'Expenses - Depreciation', 'Operating Expense', 'EBIT', 'Expenses - Financial Charges',
+        'Earnings Before Tax (EBT)', 'Taxes', 'Net Income', 'METRIC_mktg_pct_of_opex'],
+    'bs': ['Fixed Assets - Equipment (Net)', 'Current Assets - Material Inv.', 'Current Assets - Finished Inv.',
+        'Current Assets - Receivables (AR)', 'Current Assets - Cash', 'TOTAL ASSETS', 'Equity - Capital Stock',
+        'Equity - Retained Earnings', 'Equity - Net Income (Y)', 'Total Equity', 'Liabilities - Long-Term Debt',
+        'Liabilities - Bank Overdraft (ST)', 'Liabilities - Payables (AP)', 'Liabilities - Taxes Payable',
+        'Total Liabilities', 'TOTAL LIABILITIES + EQUITY', 'METRIC_ROE', 'METRIC_Current_Ratio'],
+    'inventory': ['fg_opening', 'fg_produced', 'fg_sold', 'fg_ending', 'fg_percent_sold_of_available', 'mat_opening',
+        'mat_purchased', 'mat_used', 'mat_ending'],
+}
+
+def atomic_save_npz(path, arrays):
+    """Saves {name: array} to `path` via a temporary file and os.replace, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if os.name == 'posix': # Persist the rename itself (directories cannot be opened for fsync on Windows)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def scenarios_digest(chunk_scenarios):
+    """SHA-256 over the decisions_key() of each scenario, in order: identifies the scenarios of one chunk."""
+    digest = hashlib.sha256()
+    for all_decisions in chunk_scenarios:
+        digest.update(decisions_key(all_decisions).encode('utf-8'))
+    return digest.hexdigest()
+
+def flatten_arrays(arrays):
+    """{section: {line: array}} -> {'section|line': array} (flat keys for .npz files)."""
+    return {f"{section}|{line}": values for section, section_arrays in arrays.items() for line, values in section_arrays.items()}
+
+def unflatten_arrays(flat, prefix=''):
+    arrays = {}
+    for key, values in flat.items():
+        if key.startswith(prefix):
+            section, line = key[len(prefix):].split('|', 1)
+            arrays.setdefault(section, {})[line] = values
+    return arrays
+
+def run_sweep(scenarios, checkpoint_dir, lines=SWEEP_LINES, checkpoint_every=SWEEP_CHECKPOINT_EVERY):
+    """
+    Runs run_horizon() for every decision set in `scenarios` and returns (arrays, aggregates, failures):
+    results_to_arrays() arrays for all scenarios, {'count', 'sum', 'sum_sq', 'min', 'max'} per line and year,
+    and validate_result_arrays() failures {invariant: [offending scenario IDs]} over the whole sweep.
+    Every `checkpoint_every` scenarios, the finished chunk and the running aggregates are written to
+    `checkpoint_dir` (atomic writes). Calling again with the same arguments after a crash resumes after the
+    last saved chunk and gives identical results. `scenarios` must be indexable and deterministic
+    (e.g. seed Monte Carlo draws from the scenario index): on resume, the saved chunks are checked
+    against a digest of their scenarios. Per-year debug logs are muted while scenarios run.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.npz')
+    n_scenarios = len(scenarios)
+    signature = np.array([n_scenarios, checkpoint_every])
+    keys = [f"{section}|{line}" for section, section_lines in lines.items() for line in section_lines]
+    line_keys = np.array(sorted(keys))
+    # Each chunk is converted once, with the validated lines added to the stored ones
+    converted_lines = {section: list(section_lines) for section, section_lines in lines.items()}
+    for section, section_lines in VALIDATED_LINES.items():
+        converted = converted_lines.setdefault(section, [])
+        converted.extend(line for line in section_lines if line not in converted)
+
+    def chunk_path(chunk_start):
+        return os.path.join(checkpoint_dir, f"chunk_{chunk_start:012d}.npz")
+
+    next_index, count, chunks, aggregates, failures, digests = 0, 0, [], {}, {}, []
+    if os.path.exists(manifest_path):
+        with np.load(manifest_path) as manifest:
+            if not (np.array_equal(manifest['signature'], signature) and np.array_equal(manifest['line_keys'], line_keys)):
+                raise ValueError(f"Checkpoint in {checkpoint_dir} belongs to a different sweep")
+            next_index, count = int(manifest['next_index']), int(manifest['count'])
+            aggregates = {key: manifest[key] for key in manifest.files if key.split('|', 1)[0] in SWEEP_STATS}
+            failures = {key.split('|', 1)[1]: manifest[key].tolist() for key in manifest.files if key.startswith('failures|')}
+            digests = manifest['chunk_digests'].tolist()
+        for chunk_index, chunk_start in enumerate(range(0, next_index, checkpoint_every)):
+            chunk_end = min(chunk_start + checkpoint_every, n_scenarios)
+            if scenarios_digest(scenarios[i] for i in range(chunk_start, chunk_end)) != digests[chunk_index]:
+                raise ValueError(f"Checkpoint in {checkpoint_dir} holds different scenarios for {chunk_start}-{chunk_end}")
+            with np.load(chunk_path(chunk_start)) as chunk:
+                chunks.append({key: chunk[key] for key in keys})
+        log_debug(f"Sweep resumed from {checkpoint_dir} at scenario {next_index}/{n_scenarios}")
+
+    for chunk_start in range(next_index, n_scenarios, checkpoint_every):
+        chunk_end = min(chunk_start + checkpoint_every, n_scenarios)
+        chunk_scenarios = [scenarios[i] for i in range(chunk_start, chunk_end)]
+        digests.append(scenarios_digest(chunk_scenarios))
+        with muted_logging(): # Checkpoint logs below stay on
+            chunk_results = [run_horizon(all_decisions, snapshots=False) for all_decisions in chunk_scenarios]
+        chunk_arrays = results_to_arrays(chunk_results, converted_lines)
+        chunk_failures = validate_result_arrays(chunk_arrays, scenario_ids=np.arange(chunk_start, chunk_end))
+        flat_chunk = flatten_arrays(chunk_arrays)
+        chunk = {key: flat_chunk[key] for key in keys}
+        atomic_save_npz(chunk_path(chunk_start), dict(
+            chunk, digest=np.array(digests[-1]), **{f"failures|{name}": np.array(ids) for name, ids in chunk_failures.items()}))
+        chunks.append(chunk)
+        for name, ids in chunk_failures.items():
+            failures[name] = failures.get(name, []) + ids
+            log_debug(f"Sweep: {len(ids)} scenario(s) failed {name} in chunk {chunk_start}-{chunk_end}")
+
+        # Partial aggregates, updated chunk by chunk (same order on resume -> bit-identical sums)
+        for key, values in chunk.items():
+            chunk_stats = {'sum': values.sum(axis=0), 'sum_sq': (values * values).sum(axis=0),
+                           'min': values.min(axis=0), 'max': values.max(axis=0)}
+            for stat, stat_values in chunk_stats.items():
+                previous = aggregates.get(f"{stat}|{key}")
+                if previous is None:
+                    aggregates[f"{stat}|{key}"] = stat_values
+                elif stat == 'min':
+                    aggregates[f"{stat}|{key}"] = np.minimum(previous, stat_values)
+                elif stat == 'max':
+                    aggregates[f"{stat}|{key}"] = np.maximum(previous, stat_values)
+                else:
+                    aggregates[f"{stat}|{key}"] = previous + stat_values
+        count += chunk_end - chunk_start
+
+        # The manifest is written last: a crash before this point only redoes the current chunk
+        atomic_save_npz(manifest_path, dict(aggregates, signature=signature, line_keys=line_keys,
+                                            next_index=np.array(chunk_end), count=np.array(count),
+                                            chunk_digests=np.array(digests),
+                                            **{f"failures|{name}": np.array(ids) for name, ids in failures.items()}))
+        log_debug(f"Sweep checkpoint: {chunk_end}/{n_scenarios} scenarios")
+
+    arrays = unflatten_arrays({
+        key: np.concatenate([chunk[key] for chunk in chunks]) if chunks else np.empty((0, len(YEAR_LABELS)))
+        for key in keys
+    })
+    sweep_aggregates = {'count': count}
+    for stat in SWEEP_STATS:
+        sweep_aggregates[stat] = unflatten_arrays(aggregates, prefix=f"{stat}|")
+    return arrays, sweep_aggregates, failures
+
+
+# --- 3f. COMPUTATION LINEAGE (OPT-IN TRACING) ---
+# Static dependency graph of run_one_year: {node: [nodes it is computed from]}.
+# Nodes: 'is:'/'cf:'/'bs:' output lines, local variables of run_one_year, 'bs_internal:' end-of-year state,
+# and inputs ('prev_bs:', 'decisions:', 'line_spec:', opening park figures, year_index, prev_workers, constants).
+LINEAGE_GRAPH = {
+    # Production planning
+    'target_production_volume': ['decisions:prod_volume'],
+    'new_lines_needed': ['target_production_volume', 'existing_line_capacity', 'line_spec:capacity'],
+    'investment_cash_out': ['new_lines_needed', 'line_spec:cost'],
+    'total_line_capacity': ['existing_line_capacity', 'new_lines_needed', 'line_spec:capacity'],
+    'current_workers': ['prev_workers', 'target_production_volume', 'UNITS_PER_WORKER'],
+    'total_worker_capacity': ['current_workers', 'UNITS_PER_WORKER'],
+    'production_capacity': ['total_line_capacity', 'total_worker_capacity'],
+    'production_volume': ['target_production_volume', 'production_capacity'],
+    # Sales & inventories
+    'opening_inv_units': ['prev_bs:inventory_finished_units'],
+    'total_available_for_sale': ['opening_inv_units', 'production_volume'],
+    'target_sales_units': ['decisions:target_sales_units'],
+    'actual_sales_volume': ['target_sales_units', 'total_available_for_sale'],
+    'revenue': ['actual_sales_volume', 'decisions:price'],
+    'opening_inv_fin_val': ['prev_bs:inventory_finished_value'],
+    'ending_inv_units': ['opening_inv_units', 'production_volume', 'actual_sales_volume'],
+    'ending_inv_fin_val': ['ending_inv_units', 'UNIT_COST_FOR_INVENTORY'],
+    'change_in_finished_inv': ['ending_inv_fin_val', 'opening_inv_fin_val'],
+    'operating_revenue': ['revenue', 'change_in_finished_inv'],
+    'materials_needed': ['production_volume'],
+    'materials_from_stock': ['prev_bs:inventory_materials_units'],
+    'materials_to_purchase': ['materials_needed', 'materials_from_stock'],
+    'cost_materials_to_purchase': ['materials_to_purchase', 'MATERIAL_COST_PER_UNIT'],
+    'opening_inv_mat_val': ['prev_bs:inventory_materials_value'],
+    'ending_mat_units': ['materials_from_stock', 'materials_needed', 'materials_to_purchase'],
+    'ending_inv_mat_val': ['ending_mat_units', 'MATERIAL_COST_PER_UNIT'],
+    'change_in_raw_inv': ['opening_inv_mat_val', 'ending_inv_mat_val'],
+    'material_expense': ['cost_materials_to_purchase', 'change_in_raw_inv'],
+    # Operating expenses
+    'rent_for_year': ['year_index', 'RENT_FACTORY_X7', 'RENT_FACTORY_X8_PLUS'],
+    'current_audit_fees': ['year_index'],
+    'personnel_expenses': ['current_workers', 'LABOR_COST_PER_WORKER', 'BASE_ADMIN_SALARIES'],
+    'external_expenses_base': ['rent_for_year', 'PROPERTY_TAX', 'current_audit_fees'],
+    'depreciation_expense': ['existing_line_depreciation', 'new_lines_needed', 'line_spec:depreciation'],
+    'marketing_expense': ['decisions:marketing_amount'],
+    'operating_expense': ['material_expense', 'personnel_expenses', 'external_expenses_base',
+                          'marketing_expense', 'depreciation_expense'],
+    'ebit': ['operating_revenue', 'operating_expense'],
+    # Cash flow & financing
+    'current_interest_rate': ['prev_bs:interest_rate'],
+    'interest_fixed_debt': ['prev_bs:long_term_debt', 'current_interest_rate'],
+    'current_cash_payment_rate_sales': ['year_index', 'CASH_PAYMENT_RATE_SALES_X7', 'CASH_PAYMENT_RATE_SALES_X8_PLUS'],
+    'cash_from_sales_AR': ['prev_bs:accounts_receivable'],
+    'cash_from_sales_current': ['revenue', 'current_cash_payment_rate_sales'],
+    'cash_out_purchases_AP': ['prev_bs:accounts_payable'],
+    'cash_out_purchases_current': ['cost_materials_to_purchase', 'CASH_PAYMENT_RATE_PURCHASES'],
+    'cash_out_personnel': ['personnel_expenses'],
+    'cash_out_external': ['external_expenses_base', 'marketing_expense'],
+    'cash_out_interest_fixed': ['interest_fixed_debt'],
+    'cash_out_income_tax': ['prev_bs:income_tax_payable'],
+    'tentative_total_cash_out': ['cash_out_purchases_AP', 'cash_out_purchases_current', 'cash_out_personnel',
+                                 'cash_out_external', 'cash_out_interest_fixed', 'cash_out_income_tax'],
+    'tentative_cfo': ['cash_from_sales_AR', 'cash_from_sales_current', 'tentative_total_cash_out'],
+    'cfi': ['investment_cash_out'],
+    'dividends_paid': ['decisions:dividends_amount', 'prev_bs:net_income_previous_year'],
+    'debt_repayment': ['year_index', 'decisions:refinance_loan', 'prev_bs:long_term_debt', 'EXISTING_DEBT'],
+    'new_loan_cash_in': ['year_index', 'decisions:refinance_loan', 'decisions:new_loan_amount'],
+    'cff': ['dividends_paid', 'debt_repayment', 'new_loan_cash_in'],
+    'opening_net_cash': ['prev_bs:cash', 'prev_bs:bank_overdraft'],
+    'tentative_cash_flow': ['tentative_cfo', 'cfi', 'cff'],
+    'tentative_ending_net_cash': ['opening_net_cash', 'tentative_cash_flow'],
+    'interest_overdraft': ['tentative_ending_net_cash', 'INTEREST_RATE_OVERDRAFT'],
+    'financial_charges': ['interest_fixed_debt', 'interest_overdraft'],
+    'ebt': ['ebit', 'financial_charges'],
+    'income_tax': ['ebt', 'TAX_RATE'],
+    'net_income': ['ebt', 'income_tax'],
+    'cash_out_interest': ['financial_charges'],
+    'total_cash_out_operating': ['cash_out_purchases_AP', 'cash_out_purchases_current', 'cash_out_personnel',
+                                 'cash_out_external', 'cash_out_interest', 'cash_out_income_tax'],
+    'cfo': ['cash_from_sales_AR', 'cash_from_sales_current', 'total_cash_out_operating'],
+    'net_cash_flow': ['cfo', 'cfi', 'cff'],
+    'ending_net_cash': ['opening_net_cash', 'net_cash_flow'],
+    # End-of-year state
+    'bs_internal:cash': ['ending_net_cash'],
+    'bs_internal:bank_overdraft': ['ending_net_cash'],
+    'bs_internal:accounts_receivable': ['revenue', 'current_cash_payment_rate_sales'],
+    'bs_internal:inventory_materials_value': ['ending_inv_mat_val'],
+    'bs_internal:inventory_finished_value': ['ending_inv_fin_val'],
+    'bs_internal:gross_fixed_assets': ['prev_bs:gross_fixed_assets', 'investment_cash_out'],
+    'bs_internal:accumulated_depreciation': ['prev_bs:accumulated_depreciation', 'depreciation_expense'],
+    'bs_internal:accounts_payable': ['cost_materials_to_purchase', 'CASH_PAYMENT_RATE_PURCHASES'],
+    'bs_internal:income_tax_payable': ['income_tax'],
+    'bs_internal:long_term_debt': ['prev_bs:long_term_debt', 'debt_repayment', 'new_loan_cash_in'],
+    'bs_internal:capital_stock': ['prev_bs:capital_stock'],
+    'retained_from_previous': ['prev_bs:net_income_previous_year', 'dividends_paid'],
+    'bs_internal:retained_earnings': ['prev_bs:retained_earnings', 'retained_from_previous'],
+    'bs_internal:net_income_previous_year': ['net_income'],
+    'net_fixed_assets': ['bs_internal:gross_fixed_assets', 'bs_internal:accumulated_depreciation'],
+    'total_current_assets': ['bs_internal:inventory_materials_value', 'bs_internal:inventory_finished_value',
+                             'bs_internal:accounts_receivable', 'bs_internal:cash'],
+    'total_assets': ['net_fixed_assets', 'total_current_assets'],
+    'total_equity': ['bs_internal:capital_stock', 'bs_internal:retained_earnings', 'bs_internal:net_income_previous_year'],
+    'total_current_liabilities': ['bs_internal:bank_overdraft', 'bs_internal:accounts_payable', 'bs_internal:income_tax_payable'],
+    'total_liabilities': ['bs_internal:long_term_debt', 'total_current_liabilities'],
+    # Output lines
+    'is:Revenue - Sales': ['revenue'],
+    'is:Revenue - Inventory Change (E-B)': ['change_in_finished_inv'],
+    'is:Operating Revenue': ['operating_revenue'],
+    'is:Expenses - Material Expense': ['material_expense'],
+    'is:Expenses - External (Rent, Tax...)': ['external_expenses_base'],
+    'is:Expenses - Marketing': ['marketing_expense'],
+    'is:Expenses - Personnel': ['personnel_expenses'],
+    'is:Expenses - Depreciation': ['depreciation_expense'],
+    'is:Operating Expense': ['operating_expense'],
+    'is:EBIT': ['ebit'],
+    'is:Expenses - Financial Charges': ['financial_charges'],
+    'is:Earnings Before Tax (EBT)': ['ebt'],
+    'is:Taxes': ['income_tax'],
+    'is:Net Income': ['net_income'],
+    'is:METRIC_mktg_pct_of_opex': ['marketing_expense', 'operating_expense'],
+    'cf:Opening Balance (net)': ['opening_net_cash'],
+    'cf:Operating Cash Flow (CFO)': ['cfo'],
+    'cf:... Cash In (Y-1)': ['cash_from_sales_AR'],
+    'cf:... Cash In (Y)': ['cash_from_sales_current'],
+    'cf:... Cash Out (Operating)': ['total_cash_out_operating'],
+    'cf:Cash Out - Personnel': ['cash_out_personnel'],
+    'cf:Cash Out - External & Mktg': ['external_expenses_base', 'marketing_expense'],
+    'cf:Cash Out - Interest': ['cash_out_interest'],
+    'cf:Cash Out - Taxes (from Y-1)': ['cash_out_income_tax'],
+    'cf:Cash Out - Purchases (Current 90%)': ['cash_out_purchases_current'],
+    'cf:Cash Out - Payables (from Y-1)': ['cash_out_purchases_AP'],
+    'cf:Investing Cash Flow (CFI)': ['cfi'],
+    'cf:Financing Cash Flow (CFF)': ['cff'],
+    'cf:Net Change in Cash': ['net_cash_flow'],
+    'cf:Ending Balance (net)': ['ending_net_cash'],
+    'bs:Fixed Assets - Equipment (Net)': ['net_fixed_assets'],
+    'bs:Current Assets - Material Inv.': ['bs_internal:inventory_materials_value'],
+    'bs:Current Assets - Finished Inv.': ['bs_internal:inventory_finished_value'],
+    'bs:Current Assets - Receivables (AR)': ['bs_internal:accounts_receivable'],
+    'bs:Current Assets - Cash': ['bs_internal:cash'],
+    'bs:TOTAL ASSETS': ['total_assets'],
+    'bs:Equity - Capital Stock': ['bs_internal:capital_stock'],
+    'bs:Equity - Retained Earnings': ['bs_internal:retained_earnings'],
+    'bs:Equity - Net Income (Y)': ['bs_internal:net_income_previous_year'],
+    'bs:Total Equity': ['total_equity'],
+    'bs:Liabilities - Long-Term Debt': ['bs_internal:long_term_debt'],
+    'bs:Liabilities - Bank Overdraft (ST)': ['bs_internal:bank_overdraft'],
+    'bs:Liabilities - Payables (AP)': ['bs_internal:accounts_payable'],
+    'bs:Liabilities - Taxes Payable': ['bs_internal:income_tax_payable'],
+    'bs:Total Liabilities': ['total_liabilities'],
+    'bs:TOTAL LIABILITIES + EQUITY': ['total_equity', 'total_liabilities'],
+    'bs:METRIC_ROE': ['net_income', 'total_equity'],
+    'bs:METRIC_Current_Ratio': ['total_current_assets', 'total_current_liabilities'],
+}
+LINEAGE_NODES = sorted(set(LINEAGE_GRAPH) | {dep for deps in LINEAGE_GRAPH.values() for dep in deps})
+LINEAGE_OUTPUT_SECTIONS = {'is': 'is_data', 'cf': 'cf_data', 'bs': 'bs_data'}
+
+def run_one_year_dict_keys():
+    """
+    Constant dict keys used in run_one_year's source, in source order: ({name: [keys written]}, {name: [keys read]}).
+    Writes are `name['key'] = ...`; reads are `name['key']` and `name.get('key')`.
+    """
+    written, read = {}, {}
+    nodes = [node for node in ast.walk(ast.parse(inspect.getsource(run_one_year))) if hasattr(node, 'lineno')]
+    for node in sorted(nodes, key=lambda node: (node.lineno, node.col_offset)):
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                and isinstance(node.slice, ast.Constant)):
+            keys = written if isinstance(node.ctx, ast.Store) else read
+            name, key = node.value.id, node.slice.value
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'get'
+                and isinstance(node.func.value, ast.Name) and node.args and isinstance(node.args[0], ast.Constant)):
+            keys = read
+            name, key = node.func.value.id, node.args[0].value
+        else:
+            continue
+        if key not in keys.setdefault(name, []):
+            keys[name].append(key)
+    return written, read
+
+def check_lineage_graph():
+    """
+    Developer check of LINEAGE_GRAPH against run_one_year's source (record_lineage reads its locals by name);
+    run `python engine.py` after changing run_one_year. Bare nodes must be local variables or module constants,
+    output and 'bs_internal:' keys must be written by the engine, and input keys ('prev_bs:', 'decisions:',
+    'line_spec:') must be read by it. Raises ValueError listing the stale nodes.
+    """
+    written, read = run_one_year_dict_keys()
+    local_names = set(run_one_year.__code__.co_varnames)
+    stale = []
+    for node in LINEAGE_NODES:
+        source, _, key = node.partition(':')
+        if not key:
+            known = node in local_names or (node.isupper() and node in globals())
+        elif source in LINEAGE_OUTPUT_SECTIONS or source == 'bs_internal':
+            known = key in written.get(LINEAGE_OUTPUT_SECTIONS.get(source, source), [])
+        else:
+            known = key in read.get(source, [])
+        if not known:
+            stale.append(node)
+    if stale:
+        raise ValueError(f"LINEAGE_GRAPH nodes not found in run_one_year: {stale}")
+
+def record_lineage(trace, year_locals):
+    """Stores the value of every LINEAGE_GRAPH node, read from run_one_year's locals, into `trace`."""
+    for node in LINEAGE_NODES:
+        source, _, key = node.partition(':')
+        if not key:
+            trace[node] = year_locals[node] if node in year_locals else globals()[node] # Local or constant
+        elif source in LINEAGE_OUTPUT_SECTIONS:
+            trace[node] = year_locals[LINEAGE_OUTPUT_SECTIONS[source]][key]
+        else: # prev_bs, decisions, bs_internal, line_spec
+            trace[node] = year_locals[source].get(key)
+
+def lineage_edges(node):
+    """All (node, dependency) edges reachable from `node`, each listed once, depth-first."""
+    edges, seen, stack = [], set(), [node]
+    while stack:
+        current = stack.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        for dep in LINEAGE_GRAPH.get(current, []):
+            edges.append((current, dep))
+            stack.append(dep)
+    return edges
+
+
+# --- 3g. SHARED RESULT CACHE ---
+SHARED_CACHE_MAX_ENTRIES = 512 # Per cache (horizon results / pre-rendered blocks)
+SHARED_CACHE_MAX_BYTES = 64 * 1024 * 1024 # Per cache; entry sizes are estimated from their pickled size
+SHARED_WORKBOOK_CACHE_MAX_ENTRIES = 16 # Workbooks are only built on request
+
+def decisions_key(all_decisions, trace=False):
+    """Stable hash of the X7-X11 decisions (and tracing mode): identical scenarios share one cache entry."""
+    payload = json.dumps([[all_decisions[year_label] for year_label in YEAR_LABELS], bool(trace)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with entry-count and byte limits and hit-rate counters, shared by every session of the app.
+    Cached values are shared between users and must be treated as read-only. A key is computed by one
+    session at a time: sessions asking for a key that is being computed wait for that result.
+    """
+
+    def __init__(self, max_entries=SHARED_CACHE_MAX_ENTRIES, max_bytes=SHARED_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {} # {key: estimated bytes}
+        self.total_bytes = 0
+        self.in_flight = {} # {key: threading.Event set once the computing session is done}
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions, self.waits = 0, 0, 0, 0
+
+    def get_or_compute(self, key, compute):
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+                done = self.in_flight.get(key)
+                if done is None:
+                    self.misses += 1
+                    done = self.in_flight[key] = threading.Event()
+                    break
+                self.waits += 1
+            done.wait() # Another session is computing this key; look again once it is done (or failed)
+
+        try:
+            value = compute() # Outside the lock: other keys keep being served meanwhile
+            size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            with self.lock:
+                if size <= self.max_bytes: # A value larger than the whole cache is returned uncached
+                    self.entries[key] = value
+                    self.sizes[key] = size
+                    self.total_bytes += size
+                while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                    evicted_key, _ = self.entries.popitem(last=False) # Least recently used
+                    self.total_bytes -= self.sizes.pop(evicted_key)
+                    self.evictions += 1
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
+        return value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries), 'max_entries': self.max_entries,
+                'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'waits': self.waits,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            }
+
+
+if __name__ == '__main__':
+    check_lineage_graph()
+    print(f"LINEAGE_GRAPH: {len(LINEAGE_NODES)} nodes, all found in run_one_year.")
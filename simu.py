@@ -1,391 +1,38 @@
 import streamlit as st
 import math
-import sys
-
-# --- 0. LOGGING FUNCTION ---
-def log_debug(message):
-    """Prints a log to the terminal running Streamlit."""
-    print(f"DEBUG: {message}", file=sys.stderr)
+import pandas as pd
+from engine import (
+    COMPARED_SECTIONS, DEFAULT_LINE_TYPE, INITIAL_BALANCE_SHEET, INITIAL_LINE_AGES, LINE_TYPES,
+    LINEAGE_GRAPH, LINEAGE_OUTPUT_SECTIONS, MAX_COMPARE_VARIANTS, YEAR_LABELS,
+    SHARED_WORKBOOK_CACHE_MAX_ENTRIES, LineFleet, ResultCache, compare_results, decisions_key, export_workbook, lineage_edges, log_debug,
+    results_to_arrays, run_horizon, validate_result_arrays,
+)
 
 log_debug("--- Starting Simulator Script v28 (Multi-Update) ---")
 
-# --- 1. SIMULATION CONSTANTS (based on documents) ---
-MATERIAL_COST_PER_UNIT = 18.0
-LABOR_COST_PER_WORKER = 18000.0
-UNITS_PER_WORKER = 2000.0
-LABOR_COST_PER_UNIT = LABOR_COST_PER_WORKER / UNITS_PER_WORKER # 9.0
-UNIT_COST_FOR_COGS = MATERIAL_COST_PER_UNIT # 18.0
-UNIT_COST_FOR_INVENTORY = MATERIAL_COST_PER_UNIT + LABOR_COST_PER_UNIT # 27.0
-UNITS_PER_LINE = 10000.0
-COST_PER_NEW_LINE = 50000.0
-DEPRECIATION_PER_LINE = 10000.0
-BASE_ADMIN_SALARIES = 300000.0
-RENT_FACTORY_X7 = 300000.0 # Original rent
-RENT_FACTORY_X8_PLUS = 600000.0 # New rent from X8 onwards
-PROPERTY_TAX = 40000.0
-# AUDITING_FEES = 0.0 # Removed, now dynamic
-EXISTING_DEBT = 200000.0
-INTEREST_RATE_DEBT = 0.08 # Default initial rate
-INTEREST_RATE_OVERDRAFT = 0.10
-DEBT_REPAYMENT_YEAR = 2 # Year X8
-TAX_RATE = 0.40
-CASH_PAYMENT_RATE_SALES_X7 = 0.85 # Original payment rate
-CASH_PAYMENT_RATE_SALES_X8_PLUS = 0.80 # New payment rate from X8
-CASH_PAYMENT_RATE_PURCHASES = 0.90
-
-# --- 2. INITIAL STATE (END OF YEAR X6) ---
-INITIAL_BALANCE_SHEET = {
-    'year': 'X6',
-    'cash': 70000.0,
-    'accounts_receivable': 350000.0,
-    'inventory_finished_units': 5000.0,
-    'inventory_finished_value': 135000.0,
-    'inventory_materials_units': 10000.0,
-    'inventory_materials_value': 180000.0,
-    'gross_fixed_assets': 450000.0,
-    'accumulated_depreciation': 240000.0,
-    'accounts_payable': 235000.0,
-    'income_tax_payable': 60000.0,
-    'bank_overdraft': 0.0,
-    'long_term_debt': 200000.0,
-    'capital_stock': 250000.0,
-    'retained_earnings': 110000.0,
-    'net_income_previous_year': 90000.0,
-    'interest_rate': INTEREST_RATE_DEBT, # NEW v28: Track interest rate
-}
-# Auditor-Confirmed Correct Initial Ages
-INITIAL_LINE_AGES = {
-    'age_0': 0, # New
-    'age_1': 1, # Operated 1 year
-    'age_2': 3, # Operated 2 years
-    'age_3': 3, # Operated 3 years
-    'age_4': 2, # Operated 4 years (These 2 will be scrapped at end of X7)
-}
-INITIAL_WORKERS = 50
-
-# --- 3. SIMULATION ENGINE (RUNS ONE YEAR AT A TIME) ---
-
-def run_one_year(year_label, year_index, prev_bs, prev_lines, prev_workers, decisions):
-    """
-    Simulates a single year and returns all calculated data and the new "previous state".
-    """
-    log_debug(f"--- Calculating Year {year_label} (Index {year_index}) ---")
-    
-    cf_data, is_data, bs_data, bs_internal, inventory_flow_data, lines_flow_data = {}, {}, {}, {}, {}, {}
-    
-    # --- A. STRATEGIC DECISIONS ---
-    target_production_volume = decisions['prod_volume']
-    
-    # --- B. PRODUCTION PLANNING (CAPACITY) ---
-    total_existing_lines = sum(prev_lines.values())
-    existing_line_capacity = total_existing_lines * UNITS_PER_LINE
-    log_debug(f"[{year_label}] Lines (start): {total_existing_lines} - Capacity: {existing_line_capacity}")
-    
-    new_lines_needed = 0
-    if target_production_volume > existing_line_capacity:
-        new_lines_needed = math.ceil((target_production_volume - existing_line_capacity) / UNITS_PER_LINE)
-        log_debug(f"[{year_label}] NEW LINES PURCHASED: {new_lines_needed}")
-    
-    investment_cash_out = new_lines_needed * COST_PER_NEW_LINE
-    total_lines_for_year = total_existing_lines + new_lines_needed
-    total_line_capacity = total_lines_for_year * UNITS_PER_LINE
-    
-    current_workers = prev_workers
-    existing_worker_capacity = current_workers * UNITS_PER_WORKER
-    new_workers_needed = 0
-    if target_production_volume > existing_worker_capacity:
-        new_workers_needed = math.ceil((target_production_volume - existing_worker_capacity) / UNITS_PER_WORKER)
-        log_debug(f"[{year_label}] NEW EMPLOYEES HIRED: {new_workers_needed}")
-        current_workers += new_workers_needed
-    
-    total_worker_capacity = current_workers * UNITS_PER_WORKER
-    
-    production_capacity = min(total_line_capacity, total_worker_capacity)
-    production_volume = min(target_production_volume, production_capacity)
-    log_debug(f"[{year_label}] Production: Target={target_production_volume}, Capacity={production_capacity}, Actual Production={production_volume}")
-    
-    # --- C. INCOME STATEMENT (AUDIT FIX E1) ---
-    
-    # C1. Sales & Revenue
-    opening_inv_units = prev_bs['inventory_finished_units']
-    total_available_for_sale = opening_inv_units + production_volume
-    
-    target_sales_units = decisions['target_sales_units']
-    actual_sales_volume = min(target_sales_units, total_available_for_sale)
-    
-    percent_sold_of_available = (actual_sales_volume / total_available_for_sale) if total_available_for_sale > 0 else 0
-    log_debug(f"[{year_label}] Sales: Available={total_available_for_sale}, Target={target_sales_units}, Actual Sold={actual_sales_volume} ({percent_sold_of_available*100:.1f}%)")
-    
-    revenue = actual_sales_volume * decisions['price']
-    
-    # C2. Finished Inventory Change (E-B)
-    opening_inv_fin_val = prev_bs['inventory_finished_value']
-    ending_inv_units = opening_inv_units + production_volume - actual_sales_volume
-    ending_inv_fin_val = ending_inv_units * UNIT_COST_FOR_INVENTORY # Valued at 27 CU
-    change_in_finished_inv = ending_inv_fin_val - opening_inv_fin_val # (E-B)
-    
-    # C3. Operating Revenue (Per Template)
-    operating_revenue = revenue + change_in_finished_inv
-    
-    # C4. Material Expense (Per Template)
-    materials_needed = production_volume
-    materials_from_stock = prev_bs['inventory_materials_units']
-    materials_to_purchase = max(0, materials_needed - materials_from_stock)
-    cost_materials_to_purchase = materials_to_purchase * MATERIAL_COST_PER_UNIT
-    
-    opening_inv_mat_val = prev_bs['inventory_materials_value']
-    ending_mat_units = materials_from_stock - materials_needed + materials_to_purchase
-    ending_inv_mat_val = ending_mat_units * MATERIAL_COST_PER_UNIT
-    change_in_raw_inv = opening_inv_mat_val - ending_inv_mat_val # (B-E)
-    
-    material_expense = cost_materials_to_purchase + change_in_raw_inv
-    
-    # C5. Other Operating Expenses (NEW LOGIC v28)
-    rent_for_year = RENT_FACTORY_X8_PLUS if year_index >= 2 else RENT_FACTORY_X7 # year_index 1 is X7, 2 is X8
-    
-    # NEW v28: Exceptional Audit Fee in X8
-    current_audit_fees = 0.0
-    if year_index == 2: # Year X8
-        current_audit_fees = 10000.0
-        log_debug(f"[{year_label}] Applying 10k exceptional audit fee.")
-    
-    personnel_expenses = current_workers * LABOR_COST_PER_WORKER + BASE_ADMIN_SALARIES
-    external_expenses_base = rent_for_year + PROPERTY_TAX + current_audit_fees
-    depreciation_expense = total_lines_for_year * DEPRECIATION_PER_LINE
-    
-    # C6. Marketing Expense (NEW LOGIC v28: Direct amount)
-    marketing_expense = decisions['marketing_amount']
-    
-    # C7. Total Operating Expense & EBIT
-    operating_expense = material_expense + personnel_expenses + external_expenses_base + marketing_expense + depreciation_expense
-    ebit = operating_revenue - operating_expense
-    
-    # C8. Financial Charges (NEW LOGIC v28: Dynamic rate)
-    current_interest_rate = prev_bs.get('interest_rate', INTEREST_RATE_DEBT)
-    interest_fixed_debt = prev_bs['long_term_debt'] * current_interest_rate
-    interest_overdraft = 0.0
-    
-    # --- D. CASH FLOW STATEMENT (CF) ---
-    
-    current_cash_payment_rate_sales = CASH_PAYMENT_RATE_SALES_X8_PLUS if year_index >= 2 else CASH_PAYMENT_RATE_SALES_X7
-    log_debug(f"[{year_label}] Sales cash payment rate: {current_cash_payment_rate_sales}")
-
-    # D1. Tentative Cash Flow (to find Overdraft)
-    cash_from_sales_AR = prev_bs['accounts_receivable']
-    cash_from_sales_current = revenue * current_cash_payment_rate_sales
-    
-    cash_out_purchases_AP = prev_bs['accounts_payable']
-    cash_out_purchases_current = cost_materials_to_purchase * CASH_PAYMENT_RATE_PURCHASES
-    
-    cash_out_personnel = personnel_expenses
-    cash_out_external = external_expenses_base + marketing_expense # Full cash out
-    cash_out_interest_fixed = interest_fixed_debt # Pay fixed interest
-    cash_out_income_tax = prev_bs['income_tax_payable']
-    
-    tentative_total_cash_out = (cash_out_purchases_AP + cash_out_purchases_current + 
-                                cash_out_personnel + cash_out_external + 
-                                cash_out_interest_fixed + cash_out_income_tax)
-    
-    tentative_cfo = (cash_from_sales_AR + cash_from_sales_current) - tentative_total_cash_out
-    
-    cfi = -investment_cash_out
-    
-    # D2. Dividends & Financing (NEW LOGIC v28: Refinancing)
-    dividends_paid = min(decisions['dividends_amount'], prev_bs['net_income_previous_year'])
-    
-    debt_repayment = 0
-    new_loan_cash_in = 0
-    
-    if year_index == DEBT_REPAYMENT_YEAR: # DEBT_REPAYMENT_YEAR = 2 (X8)
-        if decisions.get('refinance_loan', False):
-            # 1. Repay the old 200k loan
-            debt_repayment = min(prev_bs['long_term_debt'], EXISTING_DEBT)
-            # 2. Take out the new loan
-            new_loan_cash_in = decisions['new_loan_amount']
-            log_debug(f"[{year_label}] Refinancing: Repaying {debt_repayment}, taking new loan {new_loan_cash_in}")
-        else:
-            # Original logic: just repay
-            debt_repayment = min(prev_bs['long_term_debt'], EXISTING_DEBT)
-            log_debug(f"[{year_label}] DEBT REPAYMENT (no refinance): {debt_repayment}")
-            
-    cff = -dividends_paid - debt_repayment + new_loan_cash_in
-    
-    # D3. Overdraft Interest Calculation (AUDIT FIX E2)
-    opening_net_cash = prev_bs['cash'] - prev_bs['bank_overdraft']
-    tentative_cash_flow = tentative_cfo + cfi + cff
-    tentative_ending_net_cash = opening_net_cash + tentative_cash_flow
-    
-    if tentative_ending_net_cash < 0:
-        tentative_overdraft = -tentative_ending_net_cash
-        interest_overdraft = (tentative_overdraft * INTEREST_RATE_OVERDRAFT) / (1.0 - INTEREST_RATE_OVERDRAFT)
-        log_debug(f"[{year_label}] Overdraft interest loop: {interest_overdraft}")
-    
-    # --- E. FINAL IS, CF, and BS ---
-    
-    # E1. Final Income Statement
-    financial_charges = interest_fixed_debt + interest_overdraft
-    ebt = ebit - financial_charges # ebit was calculated before any interest
-    
-    # E2. Income Tax (AUDIT FIX E3)
-    income_tax = max(0, math.floor(ebt * TAX_RATE / 1000) * 1000)
-    net_income = ebt - income_tax
-    
-    # E3. Final Cash Flow
-    cash_out_interest = financial_charges # This is the full cash out for interest
-    total_cash_out_operating = (cash_out_purchases_AP + cash_out_purchases_current + 
-                                cash_out_personnel + cash_out_external + 
-                                cash_out_interest + cash_out_income_tax)
-    
-    cfo = (cash_from_sales_AR + cash_from_sales_current) - total_cash_out_operating
-    net_cash_flow = cfo + cfi + cff
-    ending_net_cash = opening_net_cash + net_cash_flow
-    
-    # Populate IS_DATA (for display)
-    is_data['Revenue - Sales'] = revenue
-    is_data['Revenue - Inventory Change (E-B)'] = change_in_finished_inv
-    is_data['Operating Revenue'] = operating_revenue
-    is_data['Expenses - Material Expense'] = material_expense
-    is_data['Expenses - External (Rent, Tax...)'] = external_expenses_base
-    is_data['Expenses - Marketing'] = marketing_expense
-    is_data['Expenses - Personnel'] = personnel_expenses
-    is_data['Expenses - Depreciation'] = depreciation_expense
-    is_data['Operating Expense'] = operating_expense
-    is_data['EBIT'] = ebit
-    is_data['Expenses - Financial Charges'] = financial_charges
-    is_data['Earnings Before Tax (EBT)'] = ebt
-    is_data['Taxes'] = income_tax
-    is_data['Net Income'] = net_income
-    # NEW v28: Metric for Mktg %
-    is_data['METRIC_mktg_pct_of_opex'] = (marketing_expense / operating_expense) if operating_expense > 0 else 0
-    
-    # Populate CF_DATA (for display)
-    cf_data['Opening Balance (net)'] = opening_net_cash
-    cf_data['Operating Cash Flow (CFO)'] = cfo
-    cf_data['... Cash In (Y-1)'] = cash_from_sales_AR
-    cf_data['... Cash In (Y)'] = cash_from_sales_current
-    cf_data['... Cash Out (Operating)'] = -total_cash_out_operating 
-    cf_data['Cash Out - Personnel'] = -cash_out_personnel
-    cf_data['Cash Out - External & Mktg'] = -(external_expenses_base + marketing_expense)
-    cf_data['Cash Out - Interest'] = -cash_out_interest
-    cf_data['Cash Out - Taxes (from Y-1)'] = -cash_out_income_tax
-    cf_data['Cash Out - Purchases (Current 90%)'] = -cash_out_purchases_current
-    cf_data['Cash Out - Payables (from Y-1)'] = -cash_out_purchases_AP
-    cf_data['Investing Cash Flow (CFI)'] = cfi
-    cf_data['Financing Cash Flow (CFF)'] = cff
-    cf_data['Net Change in Cash'] = net_cash_flow
-    cf_data['Ending Balance (net)'] = ending_net_cash
-    
-    # E4. Final Balance Sheet
-    if ending_net_cash >= 0:
-        bs_internal['cash'] = ending_net_cash
-        bs_internal['bank_overdraft'] = 0.0
-    else:
-        bs_internal['cash'] = 0.0
-        bs_internal['bank_overdraft'] = -ending_net_cash
-        
-    bs_internal['accounts_receivable'] = revenue * (1.0 - current_cash_payment_rate_sales)
-    bs_internal['inventory_materials_units'] = ending_mat_units
-    bs_internal['inventory_materials_value'] = ending_inv_mat_val
-    bs_internal['inventory_finished_units'] = ending_inv_units
-    bs_internal['inventory_finished_value'] = ending_inv_fin_val
-    
-    bs_internal['gross_fixed_assets'] = prev_bs['gross_fixed_assets'] + investment_cash_out
-    bs_internal['accumulated_depreciation'] = prev_bs['accumulated_depreciation'] + depreciation_expense
-    net_fixed_assets = bs_internal['gross_fixed_assets'] - bs_internal['accumulated_depreciation']
-    
-    bs_internal['accounts_payable'] = cost_materials_to_purchase * (1.0 - CASH_PAYMENT_RATE_PURCHASES)
-    bs_internal['income_tax_payable'] = income_tax
-    
-    # NEW v28: Update Debt and Interest Rate
-    bs_internal['long_term_debt'] = prev_bs['long_term_debt'] - debt_repayment + new_loan_cash_in
-    bs_internal['interest_rate'] = prev_bs.get('interest_rate', INTEREST_RATE_DEBT) # Default carry-over
-    if year_index == DEBT_REPAYMENT_YEAR and decisions.get('refinance_loan', False):
-        bs_internal['interest_rate'] = decisions['new_loan_rate'] / 100.0
-        log_debug(f"[{year_label}] New interest rate set for next year: {bs_internal['interest_rate']*100}%")
-    
-    bs_internal['capital_stock'] = prev_bs['capital_stock']
-    retained_from_previous = prev_bs['net_income_previous_year'] - dividends_paid
-    bs_internal['retained_earnings'] = prev_bs['retained_earnings'] + retained_from_previous
-    bs_internal['net_income_previous_year'] = net_income
-    
-    # Populate BS_DATA (for display)
-    bs_data['Fixed Assets - Equipment (Net)'] = net_fixed_assets
-    bs_data['Current Assets - Material Inv.'] = bs_internal['inventory_materials_value']
-    bs_data['Current Assets - Finished Inv.'] = bs_internal['inventory_finished_value']
-    bs_data['Current Assets - Receivables (AR)'] = bs_internal['accounts_receivable']
-    bs_data['Current Assets - Cash'] = bs_internal['cash']
-    total_current_assets = bs_internal['inventory_materials_value'] + bs_internal['inventory_finished_value'] + bs_internal['accounts_receivable'] + bs_internal['cash']
-    total_assets = net_fixed_assets + total_current_assets
-    bs_data['TOTAL ASSETS'] = total_assets
-    
-    bs_data['Equity - Capital Stock'] = bs_internal['capital_stock']
-    bs_data['Equity - Retained Earnings'] = bs_internal['retained_earnings']
-    bs_data['Equity - Net Income (Y)'] = bs_internal['net_income_previous_year']
-    total_equity = bs_internal['capital_stock'] + bs_internal['retained_earnings'] + bs_internal['net_income_previous_year']
-    bs_data['Total Equity'] = total_equity
-    
-    bs_data['Liabilities - Long-Term Debt'] = bs_internal['long_term_debt']
-    bs_data['Liabilities - Bank Overdraft (ST)'] = bs_internal['bank_overdraft']
-    bs_data['Liabilities - Payables (AP)'] = bs_internal['accounts_payable']
-    bs_data['Liabilities - Taxes Payable'] = bs_internal['income_tax_payable']
-    total_current_liabilities = bs_internal['bank_overdraft'] + bs_internal['accounts_payable'] + bs_internal['income_tax_payable']
-    total_liabilities = bs_internal['long_term_debt'] + total_current_liabilities
-    bs_data['Total Liabilities'] = total_liabilities
-    bs_data['TOTAL LIABILITIES + EQUITY'] = total_equity + total_liabilities
-    
-    # Metrics
-    bs_data['METRIC_ROE'] = net_income / total_equity if total_equity != 0 else 0
-    bs_data['METRIC_Current_Ratio'] = total_current_assets / total_current_liabilities if total_current_liabilities > 0 else 0
-
-    # --- F. AGING & ITERATION (AUDIT FIX E4) ---
-    next_lines = {}
-    lines_scrapped = prev_lines['age_4'] # These are the 4-year-old lines to be scrapped
-    next_lines['age_4'] = prev_lines['age_3']
-    next_lines['age_3'] = prev_lines['age_2']
-    next_lines['age_2'] = prev_lines['age_1']
-    next_lines['age_1'] = prev_lines['age_0'] 
-    next_lines['age_0'] = new_lines_needed
-    
-    if lines_scrapped > 0:
-        log_debug(f"[{year_label}] {lines_scrapped} lines (4-yr-old) were scrapped at END of year.")
-
-    # Data for this year's display
-    lines_flow_data['park_composition_start'] = prev_lines # Show state at start of year
-    lines_flow_data['opening_lines'] = total_existing_lines
-    lines_flow_data['opening_capacity'] = existing_line_capacity
-    lines_flow_data['purchased_this_year'] = new_lines_needed
-    lines_flow_data['capacity_purchased'] = new_lines_needed * UNITS_PER_LINE
-    lines_flow_data['capacity_during_year'] = total_line_capacity
-    lines_flow_data['scrapped_this_year'] = lines_scrapped
-    lines_flow_data['capacity_scrapped'] = lines_scrapped * UNITS_PER_LINE
-    lines_flow_data['ending_lines'] = total_existing_lines + new_lines_needed - lines_scrapped
-    lines_flow_data['capacity_next_year'] = lines_flow_data['ending_lines'] * UNITS_PER_LINE
-    lines_flow_data['park_composition_end'] = next_lines # EOY state for expander
-    
-    # Inventory Flow Data
-    inventory_flow_data['fg_opening'] = opening_inv_units
-    inventory_flow_data['fg_produced'] = production_volume
-    inventory_flow_data['fg_sold'] = actual_sales_volume
-    inventory_flow_data['fg_ending'] = ending_inv_units
-    inventory_flow_data['fg_percent_sold_of_available'] = percent_sold_of_available
-    inventory_flow_data['mat_opening'] = materials_from_stock
-    inventory_flow_data['mat_purchased'] = materials_to_purchase
-    inventory_flow_data['mat_used'] = materials_needed
-    inventory_flow_data['mat_ending'] = ending_mat_units
-    
-    next_workers = current_workers
-    
-    log_debug(f"[{year_label}] END Year Loop.")
-    
-    return cf_data, is_data, bs_data, bs_internal, lines_flow_data, inventory_flow_data, next_lines, next_workers
-
-
 # --- 4. USER INTERFACE (Streamlit) ---
 
 st.set_page_config(layout="wide")
 st.title("Financial Simulator (Excel Layout) - v28 (Multi-Update)")
 st.write("Model based on the ACC (EMBA) case. Includes X8+ changes, loan refinancing, and fixed marketing budget.")
 
+# --- Shared Cache (one per server process, used by every session) ---
+@st.cache_resource
+def get_shared_caches():
+    """Horizon results, pre-rendered blocks and export workbook caches, shared by all connected users."""
+    log_debug("Creating shared result caches.")
+    return ResultCache(), ResultCache(), ResultCache(max_entries=SHARED_WORKBOOK_CACHE_MAX_ENTRIES)
+
+results_cache, render_cache, workbook_cache = get_shared_caches()
+
+def cached_run(decisions, baseline=None, trace=False):
+    """run_horizon() plus the invariant check, computed once per distinct set of decisions across all sessions."""
+    def compute():
+        run = run_horizon(decisions, baseline=baseline, trace=trace)
+        run['invariant_failures'] = validate_result_arrays(results_to_arrays([run]))
+        return run
+    return results_cache.get_or_compute(decisions_key(decisions, trace), compute)
+
 # --- Sidebar for Inputs ---
 st.sidebar.header("Decision Parameters")
 st.sidebar.markdown("Use the expanders to set decisions year by year. The simulation updates automatically.")
@@ -411,6 +58,9 @@ with st.sidebar.expander("Year X7 (Mandatory)", expanded=True):
     dec_X7['dividends_amount'] = st.number_input("5.1 Dividends Paid (Year X7 only)",
         min_value=0.0, max_value=90000.0, value=12000.0, step=1000.0, key='div_X7', # User default
         help="Paid from the 90k CU profit from Y6. Capped at 90,000.")
+    if len(LINE_TYPES) > 1:
+        dec_X7['line_type'] = st.selectbox("1.4 Line Type for New Purchases", options=list(LINE_TYPES),
+            index=list(LINE_TYPES).index(DEFAULT_LINE_TYPE), key='line_type_X7')
     all_decisions['X7'] = dec_X7
 
 # NEW v28: Set defaults for X8+
@@ -420,6 +70,7 @@ dec_X8_defaults = {
     'target_sales_units': 132000,
     'marketing_amount': 345000,
     'dividends_amount': 0.0,
+    'line_type': DEFAULT_LINE_TYPE,
     # Add dummy values for refinance so copy works
     'refinance_loan': False,
     'new_loan_amount': 200000,
@@ -446,6 +97,10 @@ def create_year_sidebar(year_label, prev_year_label, default_decisions):
         dec['dividends_amount'] = st.number_input(f"Dividends Paid (Year {year_label})",
             min_value=0.0, value=0.0, step=1000.0, key=f'div_amt_{year_label}',
             help="Amount to pay from *prior year's* Net Income. Will be automatically capped at the available amount.")
+        if len(LINE_TYPES) > 1:
+            default_line_type = default_decisions.get('line_type', DEFAULT_LINE_TYPE)
+            dec['line_type'] = st.selectbox("1.4 Line Type for New Purchases", options=list(LINE_TYPES),
+                index=list(LINE_TYPES).index(default_line_type), key=f'line_type_{year_label}')
         
         # NEW v28: Loan Refinance
         if year_label == 'X8':
@@ -470,6 +125,39 @@ all_decisions['X9'] = create_year_sidebar('X9', 'X8', all_decisions['X8'])
 all_decisions['X10'] = create_year_sidebar('X10', 'X9', all_decisions['X9'])
 all_decisions['X11'] = create_year_sidebar('X11', 'X10', all_decisions['X10'])
 
+# --- Scenario Comparison (pinned baseline + variants) ---
+st.sidebar.divider()
+st.sidebar.header("Scenario Comparison")
+compare_baseline = st.session_state.get('compare_baseline')
+compare_variants = st.session_state.setdefault('compare_variants', [])
+cmp_col1, cmp_col2 = st.sidebar.columns(2)
+if cmp_col1.button("Pin as Baseline", help="Pin the current decisions as the comparison baseline."):
+    # Pinned in the current tracing mode: a traced live run only reuses a traced baseline
+    compare_baseline = cached_run(all_decisions, trace=st.session_state.get('trace_lineage', False))
+    # Saved variants are re-run against the new baseline (only their divergent years are recomputed)
+    compare_variants = [run_horizon(v['decisions'], baseline=compare_baseline) for v in compare_variants]
+    st.session_state['compare_baseline'] = compare_baseline
+    st.session_state['compare_variants'] = compare_variants
+if cmp_col2.button("Add as Variant", disabled=compare_baseline is None or len(compare_variants) >= MAX_COMPARE_VARIANTS,
+                   help=f"Compare the current decisions against the baseline (max {MAX_COMPARE_VARIANTS} variants)."):
+    compare_variants.append(run_horizon(all_decisions, baseline=compare_baseline))
+if st.sidebar.button("Clear Comparison"):
+    compare_baseline = None
+    compare_variants = []
+    st.session_state['compare_baseline'] = None
+    st.session_state['compare_variants'] = compare_variants
+if compare_baseline is not None:
+    st.sidebar.caption(f"Baseline pinned - {len(compare_variants)}/{MAX_COMPARE_VARIANTS} variants. See the Compare tab.")
+
+# --- Audit: Computation Lineage ---
+st.sidebar.divider()
+trace_lineage = st.sidebar.checkbox("Trace Computation Lineage (Audit)", value=False, key='trace_lineage',
+    help="Records the inputs and intermediate values behind every statement line, shown at the bottom of each year tab.")
+if compare_baseline is not None and ('lineage' in compare_baseline) != trace_lineage:
+    # Tracing was toggled: re-pin the same decisions in the new mode so the live run keeps reusing the baseline
+    compare_baseline = cached_run(compare_baseline['decisions'], trace=trace_lineage)
+    st.session_state['compare_baseline'] = compare_baseline
+
 st.sidebar.divider()
 st.sidebar.info("App created by Gemini (v28 - Multi-Update). The simulation runs automatically.")
 
@@ -477,45 +165,33 @@ st.sidebar.info("App created by Gemini (v28 - Multi-Update). The simulation runs
 # App is now DYNAMIC. No button, just run the simulation every time.
 
 log_debug("--- STARTING DYNAMIC SIMULATION RUN ---")
-results_cf, results_is, results_bs, results_lines, results_inventory = {}, {}, {}, {}, {}
 
-prev_bs = INITIAL_BALANCE_SHEET.copy()
-prev_lines = INITIAL_LINE_AGES.copy()
-prev_workers = INITIAL_WORKERS
-
-for year_index in range(1, 6):
-    year_label = f"X{6+year_index}"
-    decisions = all_decisions[year_label]
-    
+for year_index, year_label in enumerate(YEAR_LABELS, start=1):
     # Apply X8+ changes
     if year_index >= 2: # Year X8 (index 2) or later
         st.sidebar.warning(f"Year {year_label}: Applying X8+ rules (Rent=600k, Sales Payment=80%).")
     if year_index == 2: # Year X8
         st.sidebar.warning(f"Year {year_label}: Applying 10k exceptional audit fee.")
-    
-    cf_data, is_data, bs_data, bs_internal, lines_data, inv_data, \
-    next_lines, next_workers = run_one_year(
-        year_label, year_index, prev_bs, prev_lines, prev_workers, decisions
-    )
-    
-    results_cf[year_label] = cf_data
-    results_is[year_label] = is_data
-    results_bs[year_label] = bs_data
-    results_lines[year_label] = lines_data
-    results_inventory[year_label] = inv_data
-    
-    prev_bs = bs_internal.copy()
-    prev_lines = next_lines.copy()
-    prev_workers = next_workers
+
+# Shared across sessions; on a miss, years matching the pinned baseline are reused
+results = cached_run(all_decisions, baseline=compare_baseline, trace=trace_lineage)
+results_cf, results_is, results_bs = results['cf'], results['is'], results['bs']
+results_lines, results_inventory = results['lines'], results['inventory']
+
+# Invariant check on every run (same code path as batch sweeps, one scenario here), cached with the results
+invariant_failures = results['invariant_failures']
+if invariant_failures:
+    log_debug(f"Accounting invariants violated: {invariant_failures}")
+    st.error(f"Accounting invariants violated: {', '.join(invariant_failures)}")
 
 log_debug("--- SIMULATION COMPLETE, POPULATING TABS ---")
 
 # --- NEW: Year Selector as Tabs ---
 tab_names = ['X6', 'X7', 'X8', 'X9', 'X10', 'X11']
-tabs = st.tabs([f" **{name}** " for name in tab_names])
+tabs = st.tabs([f" **{name}** " for name in tab_names] + [" **Compare** "])
 
 # Helper function for clean display
-def show_item(label, value, is_total=False, is_sub=False, is_unit=False, is_negative=False, indent_level=1):
+def item_html(label, value, is_total=False, is_sub=False, is_unit=False, is_negative=False, indent_level=1):
     if value is None:
         value_str = "n/a"
     else:
@@ -531,16 +207,126 @@ def show_item(label, value, is_total=False, is_sub=False, is_unit=False, is_nega
     indent_px = 20 * indent_level if is_sub else 0
     indent = f"padding-left: {indent_px}px;"
     
-    st.write(f"""
-    <div style='display: flex; justify-content: space-between; border-bottom: 1px solid #eee; padding: 4px 0; {indent}'>
-        <span style='color: #444; {label_style}'>{label}</span> 
-        <b style='{label_style}'>{value_str}</b>
-    </div>
-    """, unsafe_allow_html=True)
+    return (f"<div style='display: flex; justify-content: space-between; border-bottom: 1px solid #eee; padding: 4px 0; {indent}'>"
+            f"<span style='color: #444; {label_style}'>{label}</span> <b style='{label_style}'>{value_str}</b></div>")
+
+def show_item(label, value, is_total=False, is_sub=False, is_unit=False, is_negative=False, indent_level=1):
+    st.write(item_html(label, value, is_total, is_sub, is_unit, is_negative, indent_level), unsafe_allow_html=True)
+
+# Pre-rendered statement blocks: one HTML string per statement column (cacheable, one st.markdown call each)
+BLOCK_DIVIDER_HTML = "<hr style='margin: 12px 0;'>"
+
+def block_heading_html(text):
+    return f"<div style='padding: 8px 0 4px 0;'><b>{text}</b></div>"
+
+def cash_flow_block_html(cf_display):
+    return "\n".join([
+        item_html("Opening Balance (net)", cf_display['Opening Balance (net)']),
+        item_html("Operating Cash Flow (CFO)", cf_display['Operating Cash Flow (CFO)'], is_total=True),
+        item_html("... Cash In (Y-1)", cf_display['... Cash In (Y-1)'], is_sub=True, indent_level=1),
+        item_html("... Cash In (Y)", cf_display['... Cash In (Y)'], is_sub=True, indent_level=1),
+        item_html("... Cash Out (Operating)", cf_display['... Cash Out (Operating)'], is_sub=True, is_negative=True, indent_level=1),
+        item_html("... ... Personnel", cf_display.get('Cash Out - Personnel'), is_sub=True, is_negative=True, indent_level=2),
+        item_html("... ... External & Mktg", cf_display.get('Cash Out - External & Mktg'), is_sub=True, is_negative=True, indent_level=2),
+        item_html("... ... Interest", cf_display.get('Cash Out - Interest'), is_sub=True, is_negative=True, indent_level=2),
+        item_html("... ... Taxes (from Y-1)", cf_display.get('Cash Out - Taxes (from Y-1)'), is_sub=True, is_negative=True, indent_level=2),
+        "<div style='padding-left: 40px; color: #444; font-size: 14px;'><b>... ... Cash Out for Purchases:</b></div>",
+        item_html("... ... ... Purchases (90%)", cf_display.get('Cash Out - Purchases (Current 90%)'), is_sub=True, is_negative=True, indent_level=3),
+        item_html("... ... ... Payables (from Y-1)", cf_display.get('Cash Out - Payables (from Y-1)'), is_sub=True, is_negative=True, indent_level=3),
+        item_html("Investing Cash Flow (CFI)", cf_display['Investing Cash Flow (CFI)'], is_total=True),
+        item_html("Financing Cash Flow (CFF)", cf_display['Financing Cash Flow (CFF)'], is_total=True),
+        BLOCK_DIVIDER_HTML,
+        item_html("Net Change in Cash", cf_display['Net Change in Cash']),
+        item_html("Ending Balance (net)", cf_display['Ending Balance (net)'], is_total=True),
+    ])
+
+def income_statement_block_html(is_display):
+    html = [
+        block_heading_html("Revenue"),
+        item_html("Sales", is_display['Revenue - Sales']),
+        item_html("Inventory Change (E-B)", is_display['Revenue - Inventory Change (E-B)']),
+        item_html("Total Operating Revenue", is_display.get('Operating Revenue'), is_total=True),
+        block_heading_html("Operating Expenses"),
+        item_html("Material Expense", is_display['Expenses - Material Expense']),
+        item_html("External (Rent, Tax...)", is_display['Expenses - External (Rent, Tax...)']),
+        item_html("Marketing", is_display['Expenses - Marketing']),
+    ]
+    # NEW v28: Display Mktg %
+    mktg_pct = is_display.get('METRIC_mktg_pct_of_opex')
+    if mktg_pct is not None:
+        html.append(f"<div style='text-align: right; padding-right: 10px; color: #444; font-size: 14px;'><i>({mktg_pct*100:,.1f}% of OpEx)</i></div>")
+    html += [
+        item_html("Personnel", is_display['Expenses - Personnel']),
+        item_html("Depreciation", is_display['Expenses - Depreciation']),
+        item_html("Total Operating Expense", is_display.get('Operating Expense'), is_total=True),
+        BLOCK_DIVIDER_HTML,
+        item_html("EBIT", is_display.get('EBIT'), is_total=True),
+        item_html("Financial Charges", is_display['Expenses - Financial Charges'], is_negative=True),
+        BLOCK_DIVIDER_HTML,
+        item_html("Earnings Before Tax (EBT)", is_display['Earnings Before Tax (EBT)']),
+        item_html("Taxes", is_display['Taxes'], is_negative=True),
+        BLOCK_DIVIDER_HTML,
+        item_html("Net Income", is_display['Net Income'], is_total=True),
+    ]
+    return "\n".join(html)
+
+def balance_sheet_block_html(bs_data):
+    return "\n".join([
+        block_heading_html("Assets"),
+        item_html("Equipment (Net)", bs_data['Fixed Assets - Equipment (Net)']),
+        item_html("Material Inventory", bs_data['Current Assets - Material Inv.']),
+        item_html("Finished Inventory", bs_data['Current Assets - Finished Inv.']),
+        item_html("Receivables (AR)", bs_data['Current Assets - Receivables (AR)']),
+        item_html("Cash", bs_data['Current Assets - Cash']),
+        BLOCK_DIVIDER_HTML,
+        item_html("TOTAL ASSETS", bs_data['TOTAL ASSETS'], is_total=True),
+        block_heading_html("Liabilities & Equity"),
+        item_html("Capital Stock", bs_data['Equity - Capital Stock']),
+        item_html("Retained Earnings", bs_data['Equity - Retained Earnings']),
+        item_html("Net Income (Y)", bs_data['Equity - Net Income (Y)']),
+        item_html("Total Equity", bs_data['Total Equity'], is_total=True),
+        BLOCK_DIVIDER_HTML,
+        item_html("Long-Term Debt", bs_data['Liabilities - Long-Term Debt']),
+        item_html("Bank Overdraft (ST)", bs_data['Liabilities - Bank Overdraft (ST)']),
+        item_html("Payables (AP)", bs_data['Liabilities - Payables (AP)']),
+        item_html("Taxes Payable", bs_data['Liabilities - Taxes Payable']),
+        item_html("Total Liabilities", bs_data['Total Liabilities'], is_total=True),
+        BLOCK_DIVIDER_HTML,
+        item_html("TOTAL LIABILITIES + EQUITY", bs_data['TOTAL LIABILITIES + EQUITY'], is_total=True),
+    ])
+
+def statement_blocks_html(cf_display, is_display, bs_data):
+    return {
+        'cf': cash_flow_block_html(cf_display),
+        'is': income_statement_block_html(is_display),
+        'bs': balance_sheet_block_html(bs_data),
+    }
+
+def render_horizon(results):
+    """Pre-renders what only depends on the run: statement blocks for every year."""
+    return {'statements': {
+        year_label: statement_blocks_html(results['cf'][year_label], results['is'][year_label], results['bs'][year_label])
+        for year_label in YEAR_LABELS
+    }}
+
+def show_machine_park(park_by_type, first_age, scrap_suffix):
+    """Lists line counts by age for each line type; each type's oldest age is flagged with `scrap_suffix`."""
+    for line_type, park in park_by_type.items():
+        if len(park_by_type) > 1:
+            st.markdown(f"##### {line_type.title()} Lines")
+        oldest = len(park) - 1
+        for age in range(first_age, oldest + 1):
+            suffix = scrap_suffix if age == oldest else ""
+            if age == 0:
+                st.write(f"**Lines at 0 Years Old (New){suffix}:** `{park.get('age_0', 0)}`")
+            else:
+                st.write(f"**Lines at {age} Year{'s' if age > 1 else ''} Old{suffix}:** `{park.get(f'age_{age}', 0)}`")
 
 # Function to display the data for a given year
-def display_year_data(selected_year, cf_display, is_display, bs_data, lines_flow_data, inv_display, is_static=False):
-    """Renders all the data for a specific year tab."""
+def display_year_data(selected_year, cf_display, is_display, bs_data, lines_flow_data, inv_display, is_static=False, blocks=None):
+    """Renders all the data for a specific year tab. `blocks`: pre-rendered statement_blocks_html(), if cached."""
+    if blocks is None:
+        blocks = statement_blocks_html(cf_display, is_display, bs_data)
     
     st.header(f"Financial Statement Projection - Year {selected_year}")
     if is_static:
@@ -566,80 +352,17 @@ def display_year_data(selected_year, cf_display, is_display, bs_data, lines_flow
 
     with col1:
         st.subheader("Cash Flow Budget (kCU)")
-        show_item("Opening Balance (net)", cf_display['Opening Balance (net)'])
-        show_item("Operating Cash Flow (CFO)", cf_display['Operating Cash Flow (CFO)'], is_total=True)
-        show_item("... Cash In (Y-1)", cf_display['... Cash In (Y-1)'], is_sub=True, indent_level=1)
-        show_item("... Cash In (Y)", cf_display['... Cash In (Y)'], is_sub=True, indent_level=1)
-        
-        show_item("... Cash Out (Operating)", cf_display['... Cash Out (Operating)'], is_sub=True, is_negative=True, indent_level=1)
-        show_item("... ... Personnel", cf_display.get('Cash Out - Personnel'), is_sub=True, is_negative=True, indent_level=2)
-        show_item("... ... External & Mktg", cf_display.get('Cash Out - External & Mktg'), is_sub=True, is_negative=True, indent_level=2)
-        show_item("... ... Interest", cf_display.get('Cash Out - Interest'), is_sub=True, is_negative=True, indent_level=2)
-        show_item("... ... Taxes (from Y-1)", cf_display.get('Cash Out - Taxes (from Y-1)'), is_sub=True, is_negative=True, indent_level=2)
-        
-        st.markdown("<div style='padding-left: 40px; color: #444; font-size: 14px;'><b>... ... Cash Out for Purchases:</b></div>", unsafe_allow_html=True)
-        show_item("... ... ... Purchases (90%)", cf_display.get('Cash Out - Purchases (Current 90%)'), is_sub=True, is_negative=True, indent_level=3)
-        show_item("... ... ... Payables (from Y-1)", cf_display.get('Cash Out - Payables (from Y-1)'), is_sub=True, is_negative=True, indent_level=3)
-
-        show_item("Investing Cash Flow (CFI)", cf_display['Investing Cash Flow (CFI)'], is_total=True)
-        show_item("Financing Cash Flow (CFF)", cf_display['Financing Cash Flow (CFF)'], is_total=True)
-        st.divider()
-        show_item("Net Change in Cash", cf_display['Net Change in Cash'])
-        show_item("Ending Balance (net)", cf_display['Ending Balance (net)'], is_total=True)
+        st.markdown(blocks['cf'], unsafe_allow_html=True)
         if cf_display['Ending Balance (net)'] is not None and cf_display['Ending Balance (net)'] < 0:
             st.warning(f"Bank Overdraft: {cf_display['Ending Balance (net)']/1000:,.1f} kCU")
 
     with col2:
         st.subheader("Income Statement (kCU)")
-        st.markdown("**Revenue**")
-        show_item("Sales", is_display['Revenue - Sales'])
-        show_item("Inventory Change (E-B)", is_display['Revenue - Inventory Change (E-B)'])
-        show_item("Total Operating Revenue", is_display.get('Operating Revenue'), is_total=True)
-        st.markdown("**Operating Expenses**")
-        show_item("Material Expense", is_display['Expenses - Material Expense'])
-        show_item("External (Rent, Tax...)", is_display['Expenses - External (Rent, Tax...)']) 
-        show_item("Marketing", is_display['Expenses - Marketing'])
-        # NEW v28: Display Mktg %
-        mktg_pct = is_display.get('METRIC_mktg_pct_of_opex')
-        if mktg_pct is not None:
-            st.markdown(f"<div style='text-align: right; padding-right: 10px; color: #444; font-size: 14px;'><i>({mktg_pct*100:,.1f}% of OpEx)</i></div>", unsafe_allow_html=True)
-
-        show_item("Personnel", is_display['Expenses - Personnel'])
-        show_item("Depreciation", is_display['Expenses - Depreciation'])
-        show_item("Total Operating Expense", is_display.get('Operating Expense'), is_total=True)
-        st.divider()
-        show_item("EBIT", is_display.get('EBIT'), is_total=True)
-        show_item("Financial Charges", is_display['Expenses - Financial Charges'], is_negative=True)
-        st.divider()
-        show_item("Earnings Before Tax (EBT)", is_display['Earnings Before Tax (EBT)']) 
-        show_item("Taxes", is_display['Taxes'], is_negative=True)
-        st.divider()
-        show_item("Net Income", is_display['Net Income'], is_total=True)
+        st.markdown(blocks['is'], unsafe_allow_html=True)
 
     with col3:
         st.subheader("Balance Sheet (kCU)")
-        st.markdown("**Assets**")
-        show_item("Equipment (Net)", bs_data['Fixed Assets - Equipment (Net)'])
-        show_item("Material Inventory", bs_data['Current Assets - Material Inv.'])
-        show_item("Finished Inventory", bs_data['Current Assets - Finished Inv.'])
-        show_item("Receivables (AR)", bs_data['Current Assets - Receivables (AR)'])
-        show_item("Cash", bs_data['Current Assets - Cash'])
-        st.divider()
-        show_item("TOTAL ASSETS", bs_data['TOTAL ASSETS'], is_total=True)
-        
-        st.markdown("**Liabilities & Equity**")
-        show_item("Capital Stock", bs_data['Equity - Capital Stock'])
-        show_item("Retained Earnings", bs_data['Equity - Retained Earnings'])
-        show_item("Net Income (Y)", bs_data['Equity - Net Income (Y)'])
-        show_item("Total Equity", bs_data['Total Equity'], is_total=True)
-        st.divider()
-        show_item("Long-Term Debt", bs_data['Liabilities - Long-Term Debt'])
-        show_item("Bank Overdraft (ST)", bs_data['Liabilities - Bank Overdraft (ST)'])
-        show_item("Payables (AP)", bs_data['Liabilities - Payables (AP)'])
-        show_item("Taxes Payable", bs_data['Liabilities - Taxes Payable'])
-        show_item("Total Liabilities", bs_data['Total Liabilities'], is_total=True)
-        st.divider()
-        show_item("TOTAL LIABILITIES + EQUITY", bs_data['TOTAL LIABILITIES + EQUITY'], is_total=True)
+        st.markdown(blocks['bs'], unsafe_allow_html=True)
         
         if bs_data['TOTAL ASSETS'] is not None and not math.isclose(bs_data['TOTAL ASSETS'], bs_data['TOTAL LIABILITIES + EQUITY'], rel_tol=1e-3):
             st.error(f"Balance Sheet Unbalanced! A={bs_data['TOTAL ASSETS']/1000:,.1f}k, L+E={bs_data['TOTAL LIABILITIES + EQUITY']/1000:,.1f}k")
@@ -659,11 +382,7 @@ def display_year_data(selected_year, cf_display, is_display, bs_data, lines_flow
                   delta=f"{-scrapped_in_X7:,.0f} units (To be scrapped in X7)", delta_color="inverse")
         
         with st.expander("View Detailed Machine Park (Start of X6)"):
-            park = lines_flow_data['park_composition_start']
-            st.write(f"**Lines at 1 Year Old:** `{park.get('age_1', 0)}`")
-            st.write(f"**Lines at 2 Years Old:** `{park.get('age_2', 0)}`")
-            st.write(f"**Lines at 3 Years Old:** `{park.get('age_3', 0)}`")
-            st.write(f"**Lines at 4 Years Old (To be scrapped in X7):** `{park.get('age_4', 0)}`")
+            show_machine_park(lines_flow_data['park_composition_start'], 1, " (To be scrapped in X7)")
 
     else:
         # X7-X11 Display
@@ -680,12 +399,8 @@ def display_year_data(selected_year, cf_display, is_display, bs_data, lines_flow
                       delta_color="inverse")
 
         with st.expander(f"View Detailed Machine Park (End of {selected_year})"):
-            park = lines_flow_data['park_composition_end'] # *** FIX: Show EOY state ***
-            st.write(f"**Lines at 0 Years Old (New):** `{park.get('age_0', 0)}`")
-            st.write(f"**Lines at 1 Year Old:** `{park.get('age_1', 0)}`")
-            st.write(f"**Lines at 2 Years Old:** `{park.get('age_2', 0)}`")
-            st.write(f"**Lines at 3 Years Old:** `{park.get('age_3', 0)}`")
-            st.write(f"**Lines at 4 Years Old (To be scrapped next year):** `{park.get('age_4', 0)}`")
+            # *** FIX: Show EOY state ***
+            show_machine_park(lines_flow_data['park_composition_end'], 0, " (To be scrapped next year)")
 
 
     # --- Inventory Tracking Section ---
@@ -714,6 +429,83 @@ def display_year_data(selected_year, cf_display, is_display, bs_data, lines_flow
         show_item("- Units Used", inv_display.get('mat_used'), is_unit=True, is_sub=True, is_negative=True, indent_level=1)
         show_item("Ending Stock", inv_display.get('mat_ending'), is_total=True, is_unit=True)
 
+# Function to display the baseline vs. variants comparison
+def display_comparison(baseline, variants):
+    """Renders per-line deltas (variant - baseline) for every year, one sub-tab per variant."""
+
+    st.header("Scenario Comparison (Variant - Baseline)")
+    if baseline is None:
+        st.info(f"Pin a baseline in the sidebar, then add up to {MAX_COMPARE_VARIANTS} variants to compare.")
+        return
+    if not variants:
+        st.info("Baseline pinned. Change decisions in the sidebar and click 'Add as Variant'.")
+        return
+
+    recomputed_years = sum(len(YEAR_LABELS) - v['reused_years'] for v in variants)
+    st.caption(f"{recomputed_years} of {len(variants) * len(YEAR_LABELS)} variant years computed; the rest are reused from the baseline.")
+
+    section_titles = {
+        'cf': "Cash Flow Budget (Delta, kCU)",
+        'is': "Income Statement (Delta, kCU)",
+        'bs': "Balance Sheet (Delta, kCU)",
+        'inventory': "Inventory Flow (Delta, Units)",
+    }
+    variant_tabs = st.tabs([f"Variant {i+1}" for i in range(len(variants))])
+    for variant, variant_tab in zip(variants, variant_tabs):
+        with variant_tab:
+            if variant['reused_years'] == len(YEAR_LABELS):
+                st.info("Identical decisions to the baseline: all deltas are zero.")
+            else:
+                st.info(f"Decisions diverge from the baseline in **{YEAR_LABELS[variant['reused_years']]}**.")
+            deltas = compare_results(baseline, variant)
+            for section in COMPARED_SECTIONS:
+                st.subheader(section_titles[section])
+                table = {}
+                for line, values in deltas[section].items():
+                    if line.startswith('METRIC_'): # Ratios: not scaled
+                        table[line] = [round(v, 3) for v in values]
+                    elif section == 'inventory':
+                        table[line] = [round(v, 1) for v in values]
+                    else:
+                        table[line] = [round(v / 1000.0, 1) for v in values]
+                st.dataframe(pd.DataFrame.from_dict(table, orient='index', columns=YEAR_LABELS), use_container_width=True)
+
+# Function to display the computation lineage of one statement line
+def format_lineage_value(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(value)
+    return f"{value:,.4f}" if abs(value) < 1 else f"{value:,.0f}"
+
+def display_lineage(selected_year, lineage):
+    """Renders the dependency graph (inputs -> intermediates -> line) of a chosen statement line."""
+
+    st.divider()
+    st.subheader(f"Computation Lineage - {selected_year}")
+    output_nodes = [node for node in LINEAGE_GRAPH if node.split(':', 1)[0] in LINEAGE_OUTPUT_SECTIONS]
+    node = st.selectbox("Statement line", options=output_nodes, index=output_nodes.index('is:Net Income'),
+        key=f'lineage_line_{selected_year}', help="is: Income Statement, cf: Cash Flow, bs: Balance Sheet (values in CU).")
+    edges = lineage_edges(node)
+
+    graph_nodes = list(dict.fromkeys([node] + [dep for _, dep in edges])) # Depth-first order, no duplicates
+
+    dot = ['digraph lineage {', 'rankdir=LR;', 'node [shape=box, fontsize=10];']
+    for graph_node in graph_nodes:
+        dot.append(f'"{graph_node}" [label="{graph_node}\\n{format_lineage_value(lineage[graph_node])}"];')
+    for target, dep in edges:
+        dot.append(f'"{dep}" -> "{target}";')
+    dot.append('}')
+    with st.expander("Dependency Graph", expanded=True):
+        st.graphviz_chart("\n".join(dot), use_container_width=True)
+
+    table = {
+        graph_node: [format_lineage_value(lineage[graph_node]), ", ".join(LINEAGE_GRAPH.get(graph_node, [])) or "(input)"]
+        for graph_node in graph_nodes
+    }
+    st.dataframe(pd.DataFrame.from_dict(table, orient='index', columns=["Value", "Computed From"]), use_container_width=True)
+
+# Statement blocks: rendered once per distinct scenario, shared by all sessions
+rendered = render_cache.get_or_compute(decisions_key(all_decisions), lambda: render_horizon(results))
+
 # --- Tab for Year X6 (Static) ---
 with tabs[0]:
     # (Code to build static X6 data)
@@ -762,21 +554,18 @@ with tabs[0]:
     bs_data_X6['METRIC_ROE'] = 0
     bs_data_X6['METRIC_Current_Ratio'] = current_assets / current_liabilities if current_liabilities > 0 else 0
     
-    lines_display_X6_actual = {
-        'age_0': 0, 'age_1': INITIAL_LINE_AGES['age_1'], 'age_2': INITIAL_LINE_AGES['age_2'], 
-        'age_3': INITIAL_LINE_AGES['age_3'], 'age_4': INITIAL_LINE_AGES['age_4']
-    }
     # Calculate X6 lines data
-    total_lines_X6 = sum(INITIAL_LINE_AGES.values())
-    lines_to_be_scrapped_X7 = INITIAL_LINE_AGES['age_4']
+    fleet_X6 = LineFleet.from_age_counts(INITIAL_LINE_AGES)
+    fleet_after_X7_scrap = fleet_X6.copy()
+    fleet_after_X7_scrap.advance_year({}) # Projection only: no purchases
     lines_flow_data_X6 = {
-        'park_composition_start': lines_display_X6_actual,
-        'opening_capacity': total_lines_X6 * UNITS_PER_LINE,
+        'park_composition_start': fleet_X6.as_age_dict_by_type(),
+        'opening_capacity': fleet_X6.capacity(),
         'capacity_purchased': 0,
-        'capacity_during_year': total_lines_X6 * UNITS_PER_LINE,
+        'capacity_during_year': fleet_X6.capacity(),
         'scrapped_this_year': 0, # Nothing is scrapped in X6
-        'capacity_scrapped': lines_to_be_scrapped_X7 * UNITS_PER_LINE, # This is the *projected* scrap
-        'capacity_next_year': (total_lines_X6 - lines_to_be_scrapped_X7) * UNITS_PER_LINE,
+        'capacity_scrapped': fleet_X6.capacity() - fleet_after_X7_scrap.capacity(), # This is the *projected* scrap
+        'capacity_next_year': fleet_after_X7_scrap.capacity(),
     }
 
     inv_display_X6 = {
@@ -799,7 +588,49 @@ for i, year_label in enumerate(tab_names[1:]): # Start from X7
             results_bs[year_label],
             results_lines[year_label],
             results_inventory[year_label],
-            is_static=False
+            is_static=False,
+            blocks=rendered['statements'][year_label]
         )
+        if trace_lineage:
+            display_lineage(year_label, results['lineage'][year_label])
+
+# --- Comparison Tab ---
+with tabs[-1]:
+    display_comparison(compare_baseline, compare_variants)
+
+# --- Export ---
+st.sidebar.divider()
+st.sidebar.header("Export")
+def build_workbook():
+    try:
+        return export_workbook(results)
+    except ImportError:
+        return None
+
+# The workbook is only built on request (shared cache), then offered until the decisions change
+workbook_key = decisions_key(all_decisions)
+if st.session_state.get('workbook_key') != workbook_key:
+    if st.sidebar.button("Prepare Workbook (.xlsx)", help="Builds the workbook for the current decisions."):
+        st.session_state['workbook_key'] = workbook_key
+if st.session_state.get('workbook_key') == workbook_key:
+    workbook = workbook_cache.get_or_compute(workbook_key, build_workbook)
+    if workbook is not None:
+        st.sidebar.download_button("Download Workbook (.xlsx)", data=workbook,
+            file_name="simulation_X7-X11.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            help="All years: cash flow, income statement, balance sheet, line flow and inventory flow.")
+    else:
+        st.sidebar.caption("Workbook export requires `xlsxwriter` (pip install xlsxwriter).")
+
+# --- Shared Cache Metrics ---
+results_stats, render_stats, workbook_stats = results_cache.stats(), render_cache.stats(), workbook_cache.stats()
+log_debug(f"Shared cache - results: {results_stats} - rendered: {render_stats} - workbooks: {workbook_stats}")
+st.sidebar.caption(
+    f"Shared cache (all users): results {results_stats['hit_rate']:.0%} hits "
+    f"({results_stats['entries']}/{results_stats['max_entries']} entries, "
+    f"{results_stats['bytes'] / 2**20:.1f}/{results_stats['max_bytes'] / 2**20:.0f} MB, {results_stats['evictions']} evicted), "
+    f"rendered blocks {render_stats['hit_rate']:.0%} hits, "
+    f"workbooks {workbook_stats['hit_rate']:.0%} hits "
+    f"({workbook_stats['entries']}/{workbook_stats['max_entries']} entries, {workbook_stats['evictions']} evicted)."
+)
 
 st.sidebar.info("App created by Gemini (v28 - Multi-Update).")